@@ -1,19 +1,40 @@
+import time
+PROCESS_STARTED = time.perf_counter()  # Reference point for time-to-first-served-call
 import os
 import json
 import base64
 import asyncio
 import websockets
-import time
+from datetime import datetime, timedelta
 import uuid
+import io
+import csv
+import sys
+import threading
+from collections import Counter, deque
+from contextlib import asynccontextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, execute_values
 from fastapi import FastAPI, WebSocket, Request, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from twilio.twiml.voice_response import VoiceResponse, Connect, Say
 from dotenv import load_dotenv
-import uvicorn
 import secrets
+import hmac
+import gzip
+import hashlib
+from email.utils import formatdate
+from xml.sax.saxutils import escape as xml_escape
+from html import escape as html_escape
+from urllib.parse import parse_qsl, quote, urlsplit
+try:
+    import brotli  # Optional: brotli-compressed dashboard assets
+except ImportError:
+    brotli = None
+# Rarely needed modules are imported where they are used: twilio (TwiML templates are rendered
+# once during warm-up), uvicorn (only when run as a script), audio_codec/numpy (only for
+# AUDIO_MODE=pcm16 or SILENCE_SUPPRESSION) and psycopg2.pool (when the pool is first created).
 load_dotenv()
 # =========================================
 # CONFIGURATION
@@ -25,17 +46,35 @@ PROMPT_VERSION = ""
 
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
+# psycopg2 closes returned connections beyond DB_POOL_MIN idle ones, so keep it at the steady-state
+# concurrency: three COPY writers, the health check, partition maintenance and an order save
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "6"))  # Opened during warm-up
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5"))  # Wait this long for a free connection
 
 # Deployment configuration
 PUBLIC_BASE_URL = "pizza.autoreply.my"  # Force correct domain
+
+# Multi-shop tenancy: JSON file describing each shop and its dialled numbers (unset = one shop from the settings here)
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+DEFAULT_TENANT_ID = "default"  # Answers unknown numbers and owns rows created before tenancy
 PORT = int(os.getenv("PORT", "5000"))
 
+# Twilio webhook signature validation (X-Twilio-Signature); unset = requests are not validated
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+
 # Chef Dashboard Security Configuration
 CHEF_USERNAME = os.getenv("CHEF_USERNAME", "chef")
 CHEF_PASSWORD = os.getenv("CHEF_PASSWORD", "pizza123")
 security = HTTPBasic()
 
+# Admin endpoints (profiler, loop stall dumps) stay disabled unless both are set
+ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
+
 print(f"🔐 Chef dashboard authentication configured for user: {CHEF_USERNAME}")
+if not TWILIO_AUTH_TOKEN:
+    print("⚠️  Warning: TWILIO_AUTH_TOKEN not configured. /incoming-call will accept unsigned requests.")
 
 # Function definition for OpenAI
 SAVE_ORDER_FUNCTION = {
@@ -71,6 +110,89 @@ SAVE_ORDER_FUNCTION = {
     }
 }
 VOICE = "alloy"
+# Audio mode towards OpenAI: "g711_ulaw" (passthrough) or "pcm16" (24 kHz, transcoded per call; needs numpy)
+AUDIO_MODE = os.getenv("AUDIO_MODE", "g711_ulaw")
+
+# Server VAD settings (the silence gate below is sized against these)
+VAD_PREFIX_PADDING_MS = 500
+VAD_SILENCE_DURATION_MS = 800
+
+# Optional inbound silence suppression
+SILENCE_SUPPRESSION = os.getenv("SILENCE_SUPPRESSION", "false").lower() in ("1", "true", "yes")
+
+if AUDIO_MODE == "pcm16" or SILENCE_SUPPRESSION:
+    import audio_codec
+if AUDIO_MODE == "pcm16" and not audio_codec.NUMPY_AVAILABLE:
+    print("⚠️  Warning: AUDIO_MODE=pcm16 requires numpy. Falling back to g711_ulaw.")
+    AUDIO_MODE = "g711_ulaw"
+# Hangover must outlast server VAD's silence window or turns would never end
+SILENCE_HANGOVER_MS = max(int(os.getenv("SILENCE_HANGOVER_MS", "1000")), VAD_SILENCE_DURATION_MS + 200)
+SILENCE_PREFIX_MS = max(int(os.getenv("SILENCE_PREFIX_MS", "500")), VAD_PREFIX_PADDING_MS)
+SILENCE_KEEPALIVE_MS = int(os.getenv("SILENCE_KEEPALIVE_MS", "2000"))  # 0 disables keep-alive frames
+
+# Monthly partitioning of orders, archival of delivered orders and retention export
+ORDERS_PARTITIONING = os.getenv("ORDERS_PARTITIONING", "false").lower() in ("1", "true", "yes")
+PARTITION_PRECREATE_MONTHS = int(os.getenv("PARTITION_PRECREATE_MONTHS", "3"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # Delivered orders older than this move to orders_archive
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "12"))  # Archive partitions older than this are exported and dropped (0 = keep)
+ARCHIVE_EXPORT_DIR = os.getenv("ARCHIVE_EXPORT_DIR", "archive_exports")
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", str(6 * 3600)))
+
+# Order lifecycle: each status may only advance to the next one
+ORDER_STATUS_TRANSITIONS = {"new": "preparing", "preparing": "ready", "ready": "delivered"}
+PREVIOUS_ORDER_STATUS = {after: before for before, after in ORDER_STATUS_TRANSITIONS.items()}
+
+# Upstream realtime endpoint (override to point at a local fake server for testing)
+OPENAI_REALTIME_URL = os.getenv(
+    "OPENAI_REALTIME_URL",
+    "wss://api.openai.com/v1/realtime?model=gpt-4o-mini-realtime-preview-2024-12-17"
+)
+
+# Admission control driven by upstream rate_limits.updated events
+RATE_LIMIT_THROTTLE_HEADROOM = float(os.getenv("RATE_LIMIT_THROTTLE_HEADROOM", "0.25"))  # Below this, cap response tokens
+RATE_LIMIT_QUEUE_HEADROOM = float(os.getenv("RATE_LIMIT_QUEUE_HEADROOM", "0.10"))  # Below this, hold new callers
+RATE_LIMIT_COOLDOWN_SECONDS = float(os.getenv("RATE_LIMIT_COOLDOWN_SECONDS", "20"))  # After a 429 on connect
+HOLD_SECONDS = int(os.getenv("HOLD_SECONDS", "10"))
+# An admitted call holds one of its shop's max_connections from the webhook until its upstream connects
+CALL_RESERVATION_SECONDS = float(os.getenv("CALL_RESERVATION_SECONDS", "15"))
+HOLD_MAX_ATTEMPTS = int(os.getenv("HOLD_MAX_ATTEMPTS", "3"))
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+THROTTLED_MAX_OUTPUT_TOKENS = int(os.getenv("THROTTLED_MAX_OUTPUT_TOKENS", "1024"))
+
+# Mid-call upstream reconnection
+RECONNECT_BUDGET_SECONDS = float(os.getenv("RECONNECT_BUDGET_SECONDS", "8"))  # Give up resuming after this
+RECONNECT_INITIAL_BACKOFF = 0.25
+RECONNECT_MAX_BACKOFF = 2.0
+TRANSCRIPT_REPLAY_TURNS = 30  # Compact transcript kept per call for replay
+TRANSCRIPT_REPLAY_CHARS = 500  # Per-turn cap when replaying
+
+# Batched persistence of transcripts and event timelines
+PERSIST_FLUSH_ROWS = int(os.getenv("PERSIST_FLUSH_ROWS", "500"))  # Flush once this many rows are buffered
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2.0"))  # ...or after this many seconds
+PERSIST_MAX_BUFFERED_ROWS = int(os.getenv("PERSIST_MAX_BUFFERED_ROWS", "20000"))  # Rows beyond this are dropped
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "5"))  # Failed flushes in a row before the batch is dropped
+# Column widths of the call tables; longer values are cut so one row cannot fail a whole COPY
+CALL_SID_MAX_LENGTH = 64
+TENANT_ID_MAX_LENGTH = 40
+TRANSCRIPT_ROLE_MAX_LENGTH = 16
+EVENT_TYPE_MAX_LENGTH = 80
+
+# Health checks (/healthz, /readyz) - probes only read cached results
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))  # DB round-trip and pool check
+HEALTH_UPSTREAM_CHECK_INTERVAL = float(os.getenv("HEALTH_UPSTREAM_CHECK_INTERVAL", "30"))  # TLS connect to the realtime host
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+HEALTH_MAX_DB_RTT_MS = float(os.getenv("HEALTH_MAX_DB_RTT_MS", "500"))
+HEALTH_MAX_POOL_SATURATION = float(os.getenv("HEALTH_MAX_POOL_SATURATION", "0.9"))
+HEALTH_MAX_LOOP_LAG_MS = float(os.getenv("HEALTH_MAX_LOOP_LAG_MS", "250"))
+HEALTH_MAX_UPSTREAM_CONNECT_MS = float(os.getenv("HEALTH_MAX_UPSTREAM_CONNECT_MS", "3000"))
+
+# Event-loop watchdog and sampling profiler
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "200"))  # Capture the loop's stack past this
+LOOP_WATCHDOG_INTERVAL = 0.05
+LOOP_STALLS_KEPT = 20
+LOOP_LAG_WINDOW_SECONDS = 10  # /readyz looks at the worst lag the watchdog saw in this window
+PROFILE_MAX_SECONDS = 60
+
 LOG_EVENT_TYPES = [
     "response.content.done",
     "rate_limits.updated",
@@ -80,12 +202,372 @@ LOG_EVENT_TYPES = [
     "input_audio_buffer.speech_started",
     "session.created"
 ]
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Warm everything the first call needs before serving; flush background work on shutdown"""
+    await warm_up()
+    yield
+    await shut_down()
+
+app = FastAPI(lifespan=lifespan)
 
 # Connection tracking for concurrent calls
 active_connections = 0
 phone_registry = {}  # Store phone numbers by call session
 
+# =========================================
+# RATE LIMIT TRACKING
+# =========================================
+class RateLimitTracker:
+    """
+    Shared view of the upstream rate limits across all calls.
+    Fed by rate_limits.updated events and 429s on connect; drives admission of new callers.
+    """
+
+    def __init__(self):
+        self.limits = {}  # name -> {"limit", "remaining", "reset_at"}
+        self.cooldown_until = 0.0
+        self.updated_at = None
+
+    def update(self, rate_limits):
+        """Record the limits carried by a rate_limits.updated event"""
+        now = time.monotonic()
+        for entry in rate_limits or []:
+            name = entry.get("name")
+            if not name:
+                continue
+            self.limits[name] = {
+                "limit": float(entry.get("limit") or 0),
+                "remaining": float(entry.get("remaining") or 0),
+                "reset_at": now + float(entry.get("reset_seconds") or 0)
+            }
+        self.updated_at = now
+
+    def record_connect_failure(self, retry_after=None):
+        """Treat a rejected upstream connect as zero headroom until the cooldown passes"""
+        cooldown = retry_after if retry_after else RATE_LIMIT_COOLDOWN_SECONDS
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+    def headroom(self):
+        """Lowest remaining/limit ratio across tracked limits (1.0 when unknown or already reset)"""
+        now = time.monotonic()
+        if now < self.cooldown_until:
+            return 0.0
+        ratio = 1.0
+        for entry in self.limits.values():
+            if entry["limit"] <= 0 or now >= entry["reset_at"]:
+                continue
+            ratio = min(ratio, entry["remaining"] / entry["limit"])
+        return ratio
+
+    def admission_decision(self, hold_attempt=0):
+        """Return one of: admit, throttle, queue, reject"""
+        headroom = self.headroom()
+        if headroom >= RATE_LIMIT_THROTTLE_HEADROOM:
+            return "admit"
+        if headroom >= RATE_LIMIT_QUEUE_HEADROOM:
+            return "throttle"
+        if hold_attempt < HOLD_MAX_ATTEMPTS:
+            return "queue"
+        return "reject"
+
+    def max_output_tokens(self):
+        """Response token cap to use given the current headroom"""
+        if self.headroom() < RATE_LIMIT_THROTTLE_HEADROOM:
+            return THROTTLED_MAX_OUTPUT_TOKENS
+        return DEFAULT_MAX_OUTPUT_TOKENS
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "headroom": round(self.headroom(), 3),
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - now), 1),
+            "limits": {
+                name: {
+                    "limit": entry["limit"],
+                    "remaining": entry["remaining"],
+                    "reset_seconds": round(max(0.0, entry["reset_at"] - now), 1)
+                }
+                for name, entry in self.limits.items()
+            }
+        }
+
+rate_limit_tracker = RateLimitTracker()
+admission_counts = {"admit": 0, "throttle": 0, "queue": 0, "reject": 0}
+silence_totals = {"forwarded": 0, "suppressed": 0, "upstream_bytes_saved": 0}
+
+def note_upstream_connect_failure(error):
+    """Feed a rejected upstream connect (HTTP 429) into the rate limit tracker"""
+    upstream_response = getattr(error, "response", None)
+    if getattr(upstream_response, "status_code", None) != 429:
+        return False
+    retry_after = None
+    try:
+        retry_after = float(upstream_response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        pass
+    rate_limit_tracker.record_connect_failure(retry_after)
+    return True
+
+# =========================================
+# UPSTREAM CONNECTION MANAGER
+# =========================================
+upstream_reconnect_stats = {
+    "drops": 0,
+    "successes": 0,
+    "failures": 0,
+    "latencies_ms": deque(maxlen=200)
+}
+
+def reconnect_stats_snapshot():
+    latencies = sorted(upstream_reconnect_stats["latencies_ms"])
+    drops = upstream_reconnect_stats["drops"]
+    return {
+        "drops": drops,
+        "successes": upstream_reconnect_stats["successes"],
+        "failures": upstream_reconnect_stats["failures"],
+        "success_rate": round(upstream_reconnect_stats["successes"] / drops, 3) if drops else None,
+        "p50_ms": latencies[len(latencies) // 2] if latencies else None,
+        "max_ms": latencies[-1] if latencies else None
+    }
+
+class CallState:
+    """Compact transcript and order-in-progress for one call, replayed into a fresh upstream session."""
+
+    def __init__(self):
+        self.transcript = deque(maxlen=TRANSCRIPT_REPLAY_TURNS)  # (role, text)
+        self.partial_arguments = {}  # call_id -> streamed function-call arguments
+        self.pending_order = None  # Last complete save_order arguments
+        self.saved_order_id = None
+
+    def add_turn(self, role, text):
+        text = (text or "").strip()
+        if text:
+            self.transcript.append((role, text[:TRANSCRIPT_REPLAY_CHARS]))
+
+    def add_arguments_delta(self, call_id, delta):
+        if call_id:
+            self.partial_arguments[call_id] = self.partial_arguments.get(call_id, "") + (delta or "")
+
+    def set_pending_order(self, call_id, arguments):
+        self.partial_arguments.pop(call_id, None)
+        self.pending_order = arguments
+
+    def order_summary(self):
+        """One-line note about the order so the resumed session neither loses nor duplicates it"""
+        if self.saved_order_id:
+            return f"The order was already saved as #{self.saved_order_id}. Do not call save_order again."
+        if self.pending_order:
+            return f"Order details collected so far: {json.dumps(self.pending_order, ensure_ascii=False)}"
+        partial = next(iter(self.partial_arguments.values()), "")
+        if partial:
+            return f"Partial order details collected so far (incomplete JSON): {partial}"
+        return None
+
+    def replay_items(self):
+        """conversation.item.create events rebuilding the conversation in a new session"""
+        items = []
+        for role, text in self.transcript:
+            content_type = "input_text" if role == "user" else "text"
+            items.append({
+                "type": "conversation.item.create",
+                "item": {"type": "message", "role": role, "content": [{"type": content_type, "text": text}]}
+            })
+        summary = self.order_summary()
+        if summary:
+            items.append({
+                "type": "conversation.item.create",
+                "item": {"type": "message", "role": "system", "content": [{"type": "input_text", "text": summary}]}
+            })
+        return items
+
+class CallUsage:
+    """
+    Token, turn and duration counters for one call, fed by response.done usage.
+    The event path only does integer adds; one row per call is queued for call_usage at hang-up.
+    """
+    __slots__ = ("started_at", "started", "responses", "cancelled_responses", "user_turns",
+                 "input_text_tokens", "input_audio_tokens", "cached_input_tokens",
+                 "output_text_tokens", "output_audio_tokens")
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.responses = 0
+        self.cancelled_responses = 0
+        self.user_turns = 0
+        self.input_text_tokens = 0
+        self.input_audio_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_text_tokens = 0
+        self.output_audio_tokens = 0
+
+    def add_response(self, response):
+        """Count one response.done payload (the event's "response" object)"""
+        self.responses += 1
+        if response.get("status") == "cancelled":
+            self.cancelled_responses += 1
+        usage = response.get("usage")
+        if not usage:
+            return
+        input_details = usage.get("input_token_details") or {}
+        output_details = usage.get("output_token_details") or {}
+        self.input_text_tokens += input_details.get("text_tokens") or 0
+        self.input_audio_tokens += input_details.get("audio_tokens") or 0
+        self.cached_input_tokens += input_details.get("cached_tokens") or 0
+        self.output_text_tokens += output_details.get("text_tokens") or 0
+        self.output_audio_tokens += output_details.get("audio_tokens") or 0
+
+    def row(self, call_sid, tenant, order_id):
+        """call_usage row, in usage_writer column order"""
+        return (call_sid, tenant.id, order_id, tenant.prompt_version, self.started_at.isoformat(),
+                int((time.monotonic() - self.started) * 1000), self.responses, self.cancelled_responses,
+                self.user_turns, self.input_text_tokens, self.input_audio_tokens, self.cached_input_tokens,
+                self.output_text_tokens, self.output_audio_tokens)
+
+class UpstreamConnection:
+    """
+    Realtime websocket that survives mid-call drops.
+    Iterating yields upstream messages; on a drop it reconnects with backoff within
+    RECONNECT_BUDGET_SECONDS, replays the CallState and yields a synthetic
+    upstream.reconnected event before continuing.
+    """
+
+    def __init__(self, connection_id, call_state, tenant):
+        self.connection_id = connection_id
+        self.call_state = call_state
+        self.tenant = tenant
+        self.ws = None
+        self.closing = False
+        self.gave_up = False
+        self.connected = asyncio.Event()
+
+    async def _open(self, timeout=None):
+        started = time.perf_counter()
+        try:
+            ws = await asyncio.wait_for(websockets.connect(
+                OPENAI_REALTIME_URL,
+                additional_headers={
+                    "Authorization": f"Bearer {OPENAI_API_KEY}",
+                    "OpenAI-Beta": "realtime=v1"
+                }
+            ), timeout=timeout)
+        except websockets.InvalidStatus:
+            # The host answered (e.g. 429 from org-wide rate limits): not a reachability problem,
+            # and recording it would flip /readyz on every node at once
+            raise
+        except Exception as e:
+            health_monitor.record_upstream_connect(error=str(e).strip() or type(e).__name__)
+            raise
+        health_monitor.record_upstream_connect((time.perf_counter() - started) * 1000)
+        return ws
+
+    async def __aenter__(self):
+        self.ws = await self._open()
+        self.connected.set()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        self.closing = True
+        self.connected.clear()
+        if self.ws is not None:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+
+    async def send(self, payload):
+        """Send a JSON string; dropped (returns False) while the upstream is reconnecting"""
+        if not self.connected.is_set():
+            return False
+        try:
+            await self.ws.send(payload)
+            return True
+        except websockets.ConnectionClosed:
+            self.connected.clear()
+            return False
+
+    async def __aiter__(self):
+        while True:
+            try:
+                async for message in self.ws:
+                    yield message
+            except websockets.ConnectionClosed as e:
+                print(f"⚠️ [{self.connection_id}] Upstream connection dropped: {e}")
+            if self.closing:
+                return
+            if not await self.reconnect():
+                if not self.closing:
+                    self.gave_up = True
+                return
+            if self.closing:
+                return
+            yield json.dumps({"type": "upstream.reconnected"})
+
+    async def reconnect(self):
+        """Reconnect with exponential backoff and replay call state; False if the budget runs out"""
+        self.connected.clear()
+        upstream_reconnect_stats["drops"] += 1
+        started = time.monotonic()
+        deadline = started + RECONNECT_BUDGET_SECONDS
+        backoff = RECONNECT_INITIAL_BACKOFF
+        attempt = 0
+
+        while not self.closing and time.monotonic() < deadline:
+            attempt += 1
+            ws = None
+            try:
+                ws = await self._open(timeout=deadline - time.monotonic())
+                # Wait for session.created, then configure and replay before accepting traffic
+                while True:
+                    event = json.loads(await asyncio.wait_for(ws.recv(), timeout=max(0.01, deadline - time.monotonic())))
+                    if event.get("type") == "session.created":
+                        break
+                await send_session_update(ws, self.tenant, max_output_tokens=rate_limit_tracker.max_output_tokens())
+                replay = self.call_state.replay_items()
+                for item in replay:
+                    await ws.send(json.dumps(item, ensure_ascii=False))
+                if not self.closing:
+                    await ws.send(json.dumps({
+                        "type": "response.create",
+                        "response": {"instructions": "The line dropped briefly. Apologise in one short sentence and continue the order from where you left off."}
+                    }))
+                # The caller hung up while we were reconnecting: close() already ran on the old socket,
+                # so nobody else would ever close this session
+                if self.closing:
+                    try:
+                        await ws.close()
+                    except Exception:
+                        pass
+                    return False
+
+                self.ws = ws
+                self.connected.set()
+                latency_ms = int((time.monotonic() - started) * 1000)
+                upstream_reconnect_stats["successes"] += 1
+                upstream_reconnect_stats["latencies_ms"].append(latency_ms)
+                print(f"🔁 [{self.connection_id}] Upstream resumed after {latency_ms}ms ({attempt} attempt(s), {len(replay)} items replayed)")
+                return True
+            except Exception as e:
+                print(f"❌ [{self.connection_id}] Reconnect attempt {attempt} failed: {e}")
+                note_upstream_connect_failure(e)
+                if ws is not None:
+                    try:
+                        await ws.close()
+                    except Exception:
+                        pass
+                await asyncio.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+                backoff = min(backoff * 2, RECONNECT_MAX_BACKOFF)
+
+        if self.closing:
+            return False
+        upstream_reconnect_stats["failures"] += 1
+        print(f"❌ [{self.connection_id}] Could not resume upstream within {RECONNECT_BUDGET_SECONDS}s")
+        return False
+
 # Allow app to start without API key for webhook testing
 API_KEYS_CONFIGURED = bool(OPENAI_API_KEY)
 if not API_KEYS_CONFIGURED:
@@ -97,41 +579,203 @@ if not API_KEYS_CONFIGURED:
 async def index_page():
     return {"status": "Server running", "info": "Twilio + OpenAI Realtime AI Voice", "active_connections": active_connections}
 
+@app.get("/healthz")
+async def liveness_probe():
+    """Liveness: the process is serving and its health checks are still running"""
+    alive, body = health_monitor.liveness()
+    return JSONResponse(body, status_code=200 if alive else 503)
+
+@app.get("/readyz")
+async def readiness_probe():
+    """Readiness: dependencies are healthy enough to take new calls (cached, never queries the DB)"""
+    reasons = health_monitor.readiness()
+    body = {"status": "ready" if not reasons else "not ready", "reasons": reasons, "checks": health_monitor.snapshot()}
+    return JSONResponse(body, status_code=200 if not reasons else 503)
+
 @app.get("/status")
 async def connection_status():
+    reasons = health_monitor.readiness()
+    if startup_timings["warm_s"] is None:
+        overall = "warming"
+    else:
+        overall = "healthy" if not reasons else "degraded"
     return {
-        "status": "healthy",
+        "status": overall,
+        "problems": reasons,
+        "health": health_monitor.snapshot(),
+        "loop_stalls": loop_watchdog.stats(),
+        "startup": startup_timings,
         "active_connections": active_connections,
+        "tenants": {tenant.id: tenant.snapshot() for tenant in tenants.values()},
         "concurrent_support": "enabled",
-        "api_configured": API_KEYS_CONFIGURED
+        "api_configured": API_KEYS_CONFIGURED,
+        "rate_limits": rate_limit_tracker.snapshot(),
+        "admissions": admission_counts,
+        "webhook": {"signature_validation": twilio_signature_key is not None, **webhook_stats},
+        "upstream_reconnects": reconnect_stats_snapshot(),
+        "persistence": {writer.table: writer.stats() for writer in background_writers},
+        "silence_suppression": {"enabled": SILENCE_SUPPRESSION, **silence_totals}
     }
 
 
 # =========================================
 # DATABASE FUNCTIONS
 # =========================================
+db_pool = None
+db_pool_lock = threading.Lock()
+# ThreadedConnectionPool.getconn fails at once when exhausted; callers queue here instead
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_db_pool():
+    """Shared connection pool, created on first use (normally during warm-up)"""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+                db_pool = ThreadedConnectionPool(min(DB_POOL_MIN, DB_POOL_MAX), DB_POOL_MAX, DATABASE_URL, cursor_factory=RealDictCursor)
+    return db_pool
+
 def get_db_connection():
-    """Get database connection"""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """
+    Get a pooled database connection (hand it back with release_db_connection).
+    Blocks up to DB_POOL_ACQUIRE_TIMEOUT while the pool is exhausted; call acquire_db_connection
+    from the event loop.
+    """
+    from psycopg2.pool import PoolError
+    if not db_pool_slots.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT):
+        raise PoolError(f"no database connection free within {DB_POOL_ACQUIRE_TIMEOUT}s")
+    try:
+        return get_db_pool().getconn()
+    except Exception:
+        db_pool_slots.release()
+        raise
 
-async def save_order_to_db(flavour, size, drink, address, customer_name, customer_phone=None):
+async def acquire_db_connection():
+    """get_db_connection without blocking the event loop while waiting for a free connection"""
+    return await asyncio.to_thread(get_db_connection)
+
+def release_db_connection(conn):
+    """Return a connection to the pool (any open transaction is rolled back)"""
+    try:
+        get_db_pool().putconn(conn)
+    finally:
+        db_pool_slots.release()
+
+def ensure_schema():
+    """Create the orders, call transcript/event/usage and sales rollup tables (idempotent)"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS orders (
+                id SERIAL PRIMARY KEY,
+                flavour VARCHAR(100) NOT NULL,
+                size VARCHAR(20) NOT NULL,
+                drink VARCHAR(50),
+                address TEXT NOT NULL,
+                customer_name VARCHAR(100),
+                customer_phone VARCHAR(20),
+                order_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status VARCHAR(20) DEFAULT 'new'
+            );
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS call_sid VARCHAR(64);
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS preparing_at TIMESTAMP;
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS ready_at TIMESTAMP;
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP;
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(40) NOT NULL DEFAULT 'default';
+            CREATE INDEX IF NOT EXISTS orders_tenant_time_idx ON orders (tenant_id, order_time);
+            ALTER TABLE IF EXISTS orders_archive ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(40) NOT NULL DEFAULT 'default';
+
+            CREATE TABLE IF NOT EXISTS call_transcripts (
+                call_sid VARCHAR(64) NOT NULL,
+                seq INTEGER NOT NULL,
+                role VARCHAR(16) NOT NULL,
+                text TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS call_transcripts_call_sid_idx ON call_transcripts (call_sid, seq);
+
+            CREATE TABLE IF NOT EXISTS call_events (
+                call_sid VARCHAR(64) NOT NULL,
+                seq INTEGER NOT NULL,
+                event_type VARCHAR(80) NOT NULL,
+                offset_ms INTEGER NOT NULL,
+                created_at TIMESTAMP NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS call_events_call_sid_idx ON call_events (call_sid, seq);
+
+            CREATE TABLE IF NOT EXISTS call_usage (
+                call_sid VARCHAR(64) NOT NULL,
+                tenant_id VARCHAR(40) NOT NULL DEFAULT 'default',
+                order_id INTEGER,
+                prompt_version VARCHAR(16),
+                started_at TIMESTAMP NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                responses INTEGER NOT NULL,
+                cancelled_responses INTEGER NOT NULL,
+                user_turns INTEGER NOT NULL,
+                input_text_tokens INTEGER NOT NULL,
+                input_audio_tokens INTEGER NOT NULL,
+                cached_input_tokens INTEGER NOT NULL,
+                output_text_tokens INTEGER NOT NULL,
+                output_audio_tokens INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS call_usage_tenant_time_idx ON call_usage (tenant_id, started_at);
+
+            CREATE TABLE IF NOT EXISTS sales_hourly (
+                tenant_id VARCHAR(40) NOT NULL DEFAULT 'default',
+                hour TIMESTAMP NOT NULL,
+                flavour VARCHAR(100) NOT NULL,
+                size VARCHAR(20) NOT NULL,
+                drink VARCHAR(50) NOT NULL DEFAULT '',
+                orders_count INTEGER NOT NULL DEFAULT 0,
+                delivered_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tenant_id, hour, flavour, size, drink)
+            );
+            ALTER TABLE sales_hourly ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(40) NOT NULL DEFAULT 'default';
+        """)
+        # Rollups created before tenancy are keyed without tenant_id
+        cursor.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = 'sales_hourly'::regclass AND i.indisprimary AND a.attname = 'tenant_id'
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE sales_hourly DROP CONSTRAINT sales_hourly_pkey, ADD PRIMARY KEY (tenant_id, hour, flavour, size, drink)")
+        conn.commit()
+        cursor.close()
+    finally:
+        release_db_connection(conn)
+
+async def save_order_to_db(flavour, size, drink, address, customer_name, customer_phone=None, call_sid=None, tenant_id=DEFAULT_TENANT_ID):
     """Save order to database"""
+    conn = None
     try:
-        conn = get_db_connection()
+        conn = await acquire_db_connection()
         cursor = conn.cursor()
         
+        # Insert the order and bump its hourly sales rollup in the same statement
         cursor.execute("""
-            INSERT INTO orders (flavour, size, drink, address, customer_name, customer_phone)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id, order_time
-        """, (flavour, size, drink or '', address, customer_name or '', customer_phone))
+            WITH inserted AS (
+                INSERT INTO orders (flavour, size, drink, address, customer_name, customer_phone, call_sid, tenant_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, order_time, flavour, size, drink, tenant_id
+            ),
+            rollup AS (
+                INSERT INTO sales_hourly (tenant_id, hour, flavour, size, drink, orders_count, delivered_count)
+                SELECT tenant_id, date_trunc('hour', order_time), flavour, size, COALESCE(drink, ''), 1, 0 FROM inserted
+                ON CONFLICT (tenant_id, hour, flavour, size, drink)
+                DO UPDATE SET orders_count = sales_hourly.orders_count + EXCLUDED.orders_count
+            )
+            SELECT id, order_time FROM inserted
+        """, (flavour, size, drink or '', address, customer_name or '', customer_phone, call_sid, tenant_id))
         
         result = cursor.fetchone()
         conn.commit()
         cursor.close()
-        conn.close()
         
         if result:
+            bump_orders_version()
             order_id = dict(result).get('id', 'Unknown')
             print(f"✅ Order saved: ID {order_id} - {size} {flavour} for {customer_name or 'Unknown'}")
             return dict(result)
@@ -140,19 +784,690 @@ async def save_order_to_db(flavour, size, drink, address, customer_name, custome
             return None
     except Exception as e:
         print(f"❌ Error saving order: {e}")
+        if conn is not None:
+            conn.rollback()
         return None
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+
+def apply_status_transitions(transitions, tenant_id=DEFAULT_TENANT_ID):
+    """
+    Apply (order_id, expected_status, new_status) transitions to one tenant's orders in one statement and transaction.
+    A row only changes if it is still in expected_status (optimistic concurrency); each
+    transition stamps its <status>_at column for prep-time stats, and deliveries are
+    counted into the hourly sales rollup.
+    Returns [{"id", "applied", "current_status"}] in request order.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        results = execute_values(cursor, """
+            WITH requested (id, expected_status, new_status, tenant_id) AS (VALUES %s),
+            updated AS (
+                UPDATE orders AS o SET
+                    status = r.new_status,
+                    preparing_at = CASE WHEN r.new_status = 'preparing' THEN CURRENT_TIMESTAMP ELSE o.preparing_at END,
+                    ready_at = CASE WHEN r.new_status = 'ready' THEN CURRENT_TIMESTAMP ELSE o.ready_at END,
+                    delivered_at = CASE WHEN r.new_status = 'delivered' THEN CURRENT_TIMESTAMP ELSE o.delivered_at END
+                FROM requested AS r
+                WHERE o.id = r.id AND o.tenant_id = r.tenant_id AND o.status = r.expected_status
+                RETURNING o.id, o.tenant_id, o.status, o.order_time, o.flavour, o.size, o.drink
+            ),
+            rollup AS (
+                INSERT INTO sales_hourly (tenant_id, hour, flavour, size, drink, orders_count, delivered_count)
+                SELECT tenant_id, date_trunc('hour', order_time), flavour, size, COALESCE(drink, ''), 0, COUNT(*)
+                FROM updated WHERE status = 'delivered'
+                GROUP BY 1, 2, 3, 4, 5
+                ON CONFLICT (tenant_id, hour, flavour, size, drink)
+                DO UPDATE SET delivered_count = sales_hourly.delivered_count + EXCLUDED.delivered_count
+            )
+            SELECT r.id, u.id IS NOT NULL AS applied, COALESCE(u.status, o.status) AS current_status
+            FROM requested AS r
+            LEFT JOIN updated AS u ON u.id = r.id
+            LEFT JOIN orders AS o ON o.id = r.id AND o.tenant_id = r.tenant_id
+        """, [(order_id, expected, new, tenant_id) for order_id, expected, new in transitions],
+            page_size=max(1, len(transitions)), fetch=True)
+        conn.commit()
+        cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+    if any(row["applied"] for row in results):
+        bump_orders_version()
+    by_id = {row["id"]: dict(row) for row in results}
+    return [by_id[order_id] for order_id, _, _ in transitions if order_id in by_id]
+
+# =========================================
+# BACKGROUND PERSISTENCE
+# =========================================
+class BatchedCopyWriter:
+    """
+    Buffers rows in memory and writes them to one table with COPY, flushing on
+    PERSIST_FLUSH_ROWS or PERSIST_FLUSH_INTERVAL. The buffer is bounded: rows
+    arriving while it is full are dropped and counted instead of blocking calls.
+    A batch Postgres rejects is bisected so only the offending rows are dropped; any other
+    failure is retried up to PERSIST_MAX_RETRIES times in a row before the batch is given up.
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.rows = []
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed_flushes = 0
+        self.retries = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def add(self, row):
+        if len(self.rows) >= PERSIST_MAX_BUFFERED_ROWS:
+            self.dropped += 1
+            return False
+        self.rows.append(row)
+        if len(self.rows) >= PERSIST_FLUSH_ROWS:
+            self._wake.set()
+        return True
+
+    def pending(self, column, value):
+        """Buffered rows (as dicts) whose column equals value - lets readers see unflushed data"""
+        index = self.columns.index(column)
+        return [dict(zip(self.columns, row)) for row in self.rows if row[index] == value]
+
+    def _copy(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+            conn.commit()
+            cursor.close()
+        finally:
+            release_db_connection(conn)
+
+    def _copy_isolating(self, rows):
+        """COPY rows, bisecting around rows Postgres rejects; returns how many were rejected"""
+        try:
+            self._copy(rows)
+            return 0
+        except (psycopg2.DataError, psycopg2.IntegrityError):
+            if len(rows) == 1:
+                return 1
+        middle = len(rows) // 2
+        return self._copy_isolating(rows[:middle]) + self._copy_isolating(rows[middle:])
+
+    async def flush(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            rejected = await asyncio.to_thread(self._copy_isolating, rows)
+            self.written += len(rows) - rejected
+            self.retries = 0
+            if rejected:
+                self.rejected += rejected
+                self.dropped += rejected
+                print(f"⚠️ Dropped {rejected} row(s) rejected by {self.table}")
+        except Exception as e:
+            self.failed_flushes += 1
+            self.retries += 1
+            if self.retries > PERSIST_MAX_RETRIES:
+                self.retries = 0
+                self.dropped += len(rows)
+                print(f"❌ Giving up on {len(rows)} rows for {self.table} after {PERSIST_MAX_RETRIES} retries: {e}")
+                return
+            # Put the batch back for the next attempt, keeping the buffer bounded
+            room = max(0, PERSIST_MAX_BUFFERED_ROWS - len(self.rows))
+            self.dropped += max(0, len(rows) - room)
+            self.rows = rows[:room] + self.rows
+            print(f"❌ Error flushing {len(rows)} rows to {self.table}: {e}")
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=PERSIST_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping:
+                return
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Never cancel the loop: a cancelled flush has already taken its batch out of self.rows
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "buffered": len(self.rows),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failed_flushes": self.failed_flushes
+        }
+
+transcript_writer = BatchedCopyWriter("call_transcripts", ["call_sid", "seq", "role", "text", "created_at"])
+event_writer = BatchedCopyWriter("call_events", ["call_sid", "seq", "event_type", "offset_ms", "created_at"])
+usage_writer = BatchedCopyWriter("call_usage", [
+    "call_sid", "tenant_id", "order_id", "prompt_version", "started_at", "duration_ms", "responses",
+    "cancelled_responses", "user_turns", "input_text_tokens", "input_audio_tokens", "cached_input_tokens",
+    "output_text_tokens", "output_audio_tokens"
+])
+background_writers = [transcript_writer, event_writer, usage_writer]
+
+async def start_background_writers():
+    if not DATABASE_URL:
+        print("⚠️  Warning: DATABASE_URL not configured. Transcripts will not be persisted.")
+        return
+    try:
+        await asyncio.to_thread(ensure_schema)
+    except Exception as e:
+        print(f"❌ Error ensuring database schema: {e}")
+    for writer in background_writers:
+        writer.start()
+
+async def stop_background_writers():
+    for writer in background_writers:
+        await writer.stop()
+
+# =========================================
+# ORDER PARTITIONING & RETENTION
+# =========================================
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def _is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    return bool(row) and row["relkind"] == "p"
+
+def _create_month_partition(cursor, table, month):
+    """Create <table>_pYYYYMM covering one month, if missing"""
+    cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+        sql.Identifier(f"{table}_p{month:%Y%m}"), sql.Identifier(table)
+    ), (month, _add_months(month, 1)))
+
+def _order_columns(cursor):
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS type
+        FROM pg_attribute a
+        WHERE a.attrelid = 'orders'::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """)
+    return [(row["attname"], row["type"]) for row in cursor.fetchall()]
+
+def migrate_orders_to_partitioned():
+    """
+    One-off conversion of the plain orders heap into a table range-partitioned by month
+    on order_time. The old table is kept as orders_legacy until dropped by hand.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if _is_partitioned(cursor, "orders"):
+            return False
+        print("🗂️ Migrating orders to a monthly partitioned table...")
+        cursor.execute("LOCK TABLE orders IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("ALTER TABLE orders RENAME TO orders_legacy")
+        cursor.execute("ALTER INDEX IF EXISTS orders_pkey RENAME TO orders_legacy_pkey")
+        cursor.execute("ALTER INDEX IF EXISTS orders_tenant_time_idx RENAME TO orders_legacy_tenant_time_idx")
+        cursor.execute("CREATE TABLE orders (LIKE orders_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (order_time)")
+        # The partition key has to be part of the primary key
+        cursor.execute("ALTER TABLE orders ADD PRIMARY KEY (id, order_time)")
+        cursor.execute("CREATE INDEX orders_status_time_idx ON orders (status, order_time)")
+        cursor.execute("CREATE INDEX orders_tenant_time_idx ON orders (tenant_id, order_time)")
+        cursor.execute("SELECT pg_get_serial_sequence('orders_legacy', 'id') AS seq")
+        sequence = cursor.fetchone()["seq"]
+        if sequence:
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY orders.id")
+
+        cursor.execute("SELECT MIN(order_time) AS first FROM orders_legacy")
+        first = cursor.fetchone()["first"] or datetime.now()
+        month = _month_start(first)
+        last = _add_months(_month_start(datetime.now()), PARTITION_PRECREATE_MONTHS)
+        while month <= last:
+            _create_month_partition(cursor, "orders", month)
+            month = _add_months(month, 1)
+        cursor.execute("CREATE TABLE IF NOT EXISTS orders_default PARTITION OF orders DEFAULT")
+
+        columns = sql.SQL(", ").join(sql.Identifier(name) for name, _ in _order_columns(cursor))
+        cursor.execute(sql.SQL("INSERT INTO orders ({cols}) SELECT {cols} FROM orders_legacy WHERE order_time IS NOT NULL").format(cols=columns))
+        moved = cursor.rowcount
+        # order_time is part of the new primary key, so rows without one cannot move; say so instead of losing them quietly
+        cursor.execute("SELECT COUNT(*) AS skipped FROM orders_legacy WHERE order_time IS NULL")
+        skipped = cursor.fetchone()["skipped"]
+        conn.commit()
+        cursor.close()
+        print(f"✅ Orders migrated to partitioned table ({moved} rows); orders_legacy kept for manual cleanup")
+        if skipped:
+            print(f"⚠️ {skipped} order(s) without order_time were left in orders_legacy; set order_time and copy them over by hand")
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def ensure_order_partitions():
+    """Pre-create this month's and the next PARTITION_PRECREATE_MONTHS partitions, plus the archive table"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if not _is_partitioned(cursor, "orders"):
+            return
+        current = _month_start(datetime.now())
+        for offset in range(PARTITION_PRECREATE_MONTHS + 1):
+            _create_month_partition(cursor, "orders", _add_months(current, offset))
+        cursor.execute("CREATE TABLE IF NOT EXISTS orders_archive (LIKE orders INCLUDING DEFAULTS) PARTITION BY RANGE (order_time)")
+        conn.commit()
+        cursor.close()
+    finally:
+        release_db_connection(conn)
+
+def archive_delivered_orders():
+    """Move delivered orders older than ARCHIVE_AFTER_DAYS into monthly orders_archive partitions"""
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # Columns added to orders later (ALTER TABLE) must exist on the archive too
+        order_columns = _order_columns(cursor)
+        for name, column_type in order_columns:
+            cursor.execute(sql.SQL("ALTER TABLE orders_archive ADD COLUMN IF NOT EXISTS {} " + column_type).format(sql.Identifier(name)))
+        cursor.execute("""
+            SELECT DISTINCT date_trunc('month', order_time) AS month FROM orders
+            WHERE status = 'delivered' AND order_time < %s
+        """, (cutoff,))
+        for row in cursor.fetchall():
+            _create_month_partition(cursor, "orders_archive", row["month"])
+
+        columns = sql.SQL(", ").join(sql.Identifier(name) for name, _ in order_columns)
+        cursor.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM orders WHERE status = 'delivered' AND order_time < %s
+                RETURNING {cols}
+            )
+            INSERT INTO orders_archive ({cols}) SELECT {cols} FROM moved
+        """).format(cols=columns), (cutoff,))
+        archived = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        if archived:
+            bump_orders_version()
+            print(f"🗄️ Archived {archived} delivered orders older than {ARCHIVE_AFTER_DAYS} days")
+        return archived
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def export_expired_archive_partitions():
+    """Stream archive partitions older than RETENTION_MONTHS to gzip CSV files, then drop them"""
+    if RETENTION_MONTHS <= 0:
+        return []
+    oldest_kept = _add_months(_month_start(datetime.now()), -RETENTION_MONTHS)
+    exported = []
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'orders_archive'::regclass ORDER BY c.relname
+        """)
+        partitions = [row["relname"] for row in cursor.fetchall()]
+        os.makedirs(ARCHIVE_EXPORT_DIR, exist_ok=True)
+        for partition in partitions:
+            try:
+                month = datetime.strptime(partition.rsplit("_p", 1)[1], "%Y%m")
+            except (IndexError, ValueError):
+                continue
+            if month >= oldest_kept:
+                continue
+            path = os.path.join(ARCHIVE_EXPORT_DIR, f"{partition}.csv.gz")
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8") as export_file:
+                cursor.copy_expert(
+                    sql.SQL("COPY (SELECT * FROM {}) TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(partition)).as_string(conn),
+                    export_file
+                )
+            os.replace(path + ".tmp", path)
+            cursor.execute(sql.SQL("ALTER TABLE orders_archive DETACH PARTITION {}").format(sql.Identifier(partition)))
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+            conn.commit()
+            exported.append(path)
+            print(f"📦 Exported and dropped archive partition {partition} -> {path}")
+        cursor.close()
+        return exported
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def run_partition_maintenance():
+    ensure_order_partitions()
+    archive_delivered_orders()
+    export_expired_archive_partitions()
+
+async def partition_maintenance_loop():
+    while True:
+        try:
+            await asyncio.to_thread(run_partition_maintenance)
+        except Exception as e:
+            print(f"❌ Error in partition maintenance: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+partition_maintenance_task = None
+
+async def start_partition_maintenance():
+    global partition_maintenance_task
+    if not (DATABASE_URL and ORDERS_PARTITIONING):
+        return
+    try:
+        await asyncio.to_thread(migrate_orders_to_partitioned)
+    except Exception as e:
+        print(f"❌ Error migrating orders to partitions: {e}")
+        return
+    partition_maintenance_task = asyncio.create_task(partition_maintenance_loop())
+
+async def stop_partition_maintenance():
+    if partition_maintenance_task:
+        partition_maintenance_task.cancel()
+
+# =========================================
+# SALES ROLLUPS
+# =========================================
+REPORT_GROUPINGS = {
+    "hour": "hour",
+    "day": "date_trunc('day', hour)",
+    "flavour": "flavour",
+    "size": "size",
+    "drink": "drink"
+}
+
+def backfill_sales_rollups(start=None, end=None, tenant_id=None):
+    """
+    Recompute sales_hourly for [start, end) from orders and orders_archive, for one tenant or all.
+    Defaults to the oldest retained order up to the start of the current hour;
+    live increments keep the rollups current from then on.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT date_trunc('hour', CURRENT_TIMESTAMP)::timestamp AS now_hour")
+        end = end or cursor.fetchone()["now_hour"]
+        cursor.execute("SELECT to_regclass('orders_archive') IS NOT NULL AS has_archive")
+        source = "SELECT tenant_id, order_time, flavour, size, drink, status FROM orders"
+        if cursor.fetchone()["has_archive"]:
+            source += " UNION ALL SELECT tenant_id, order_time, flavour, size, drink, status FROM orders_archive"
+        tenant_filter = "AND tenant_id = %(tenant_id)s" if tenant_id else ""
+        params = {"tenant_id": tenant_id}
+        if start is None:
+            # Never wipe rollups for history whose raw rows were already exported and dropped
+            cursor.execute(f"SELECT date_trunc('hour', MIN(order_time)) AS first_hour FROM ({source}) AS all_orders WHERE TRUE {tenant_filter}", params)
+            start = cursor.fetchone()["first_hour"] or end
+        params.update(start=start, end=end)
+
+        cursor.execute(f"DELETE FROM sales_hourly WHERE hour >= %(start)s AND hour < %(end)s {tenant_filter}", params)
+        cursor.execute(f"""
+            INSERT INTO sales_hourly (tenant_id, hour, flavour, size, drink, orders_count, delivered_count)
+            SELECT tenant_id, date_trunc('hour', order_time), flavour, size, COALESCE(drink, ''),
+                   COUNT(*), COUNT(*) FILTER (WHERE status = 'delivered')
+            FROM ({source}) AS all_orders
+            WHERE order_time >= %(start)s AND order_time < %(end)s {tenant_filter}
+            GROUP BY 1, 2, 3, 4, 5
+        """, params)
+        rows = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        print(f"📊 Backfilled {rows} sales rollup rows for {start} → {end} ({tenant_id or 'all tenants'})")
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def query_sales_report(start, end, group_by, tenant_id=DEFAULT_TENANT_ID):
+    """Aggregate sales_hourly only - cost depends on the date range, not on the number of orders"""
+    grouping = REPORT_GROUPINGS[group_by]
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {grouping} AS key, SUM(orders_count) AS orders, SUM(delivered_count) AS delivered
+            FROM sales_hourly
+            WHERE tenant_id = %s AND hour >= %s AND hour < %s
+            GROUP BY 1
+            ORDER BY {"1" if group_by in ("hour", "day") else "2 DESC"}
+        """, (tenant_id, start, end))
+        rows = [dict(row) for row in cursor.fetchall()]
+        cursor.close()
+        return rows
+    finally:
+        release_db_connection(conn)
+
+# =========================================
+# USAGE REPORTS
+# =========================================
+USAGE_GROUPINGS = {
+    "day": "date_trunc('day', started_at)",
+    "prompt": "prompt_version",
+    "outcome": "CASE WHEN order_id IS NULL THEN 'no order' ELSE 'order' END"
+}
+USAGE_COUNTERS = [
+    "duration_ms", "responses", "cancelled_responses", "user_turns", "input_text_tokens", "input_audio_tokens",
+    "cached_input_tokens", "output_text_tokens", "output_audio_tokens"
+]
+
+def query_usage_report(start, end, group_by, tenant_id=DEFAULT_TENANT_ID):
+    """Summed per-call usage for calls started in [start, end)"""
+    grouping = USAGE_GROUPINGS[group_by]
+    sums = ", ".join(f"SUM({column}) AS {column}" for column in USAGE_COUNTERS)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {grouping} AS key, COUNT(*) AS calls, COUNT(order_id) AS orders, {sums}
+            FROM call_usage
+            WHERE tenant_id = %s AND started_at >= %s AND started_at < %s
+            GROUP BY 1
+            ORDER BY 1
+        """, (tenant_id, start, end))
+        rows = [dict(row) for row in cursor.fetchall()]
+        cursor.close()
+        return rows
+    finally:
+        release_db_connection(conn)
+
+def summarize_usage(row):
+    """Add the per-call, per-order and per-response ratios used to compare prompts and response caps"""
+    calls, orders, responses = row["calls"], row["orders"], row["responses"]
+    input_tokens = row["input_text_tokens"] + row["input_audio_tokens"]
+    output_tokens = row["output_text_tokens"] + row["output_audio_tokens"]
+    return {
+        **row,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "conversion_rate": round(orders / calls, 3) if calls else None,
+        "avg_call_seconds": round(row["duration_ms"] / calls / 1000, 1) if calls else None,
+        "avg_user_turns": round(row["user_turns"] / calls, 1) if calls else None,
+        "tokens_per_call": round((input_tokens + output_tokens) / calls) if calls else None,
+        # Every call's tokens, including calls that never ordered, divided over the orders taken
+        "tokens_per_order": round((input_tokens + output_tokens) / orders) if orders else None,
+        "output_tokens_per_response": round(output_tokens / responses) if responses else None
+    }
+
+# =========================================
+# TENANTS
+# =========================================
+def normalize_number(number):
+    """Digits only, so '+92 300-1234567', 'whatsapp:+923001234567' and '923001234567' all match"""
+    return "".join(ch for ch in str(number or "") if ch.isdigit())
+
+class Tenant:
+    """
+    One shop served from this process: dialled numbers, prompt, voice, menu, call limit and
+    dashboard login. Session payloads are serialized once per tenant, so the per-call cost
+    does not grow with the number of tenants.
+    """
+
+    def __init__(self, tenant_id, name, prompt, voice=VOICE, menu=None, numbers=(), public_base_url=PUBLIC_BASE_URL,
+                 max_connections=0, chef_username=None, chef_password=None):
+        self.id = tenant_id
+        self.name = name
+        self.prompt = prompt
+        self.voice = voice
+        self.menu = menu or {}  # {"flavours": [...], "sizes": [...], "drinks": [...]}
+        self.numbers = [normalize_number(number) for number in numbers]
+        self.public_base_url = public_base_url
+        self.max_connections = max_connections  # 0 = no per-tenant limit
+        self.chef_username = chef_username
+        self.chef_password = chef_password
+        self.active_calls = 0
+        self.reserved_calls = {}  # CallSid -> monotonic expiry, for calls admitted but not yet streaming
+        self.session_payloads = {}  # max_response_output_tokens -> serialized session.update
+        self.dashboard_html = None  # Dashboard shell with this shop's name, built once
+        self.prompt_version = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]  # Groups usage by prompt revision
+
+    def session_payload(self, max_output_tokens):
+        payload = self.session_payloads.get(max_output_tokens)
+        if payload is None:
+            payload = json.dumps(build_session_update(self, max_output_tokens))
+            self.session_payloads[max_output_tokens] = payload
+        return payload
+
+    def dashboard_asset(self):
+        if self.dashboard_html is None:
+            self.dashboard_html = build_dashboard_html_asset(self.name)
+        return self.dashboard_html
+
+    def at_capacity(self):
+        if not self.max_connections:
+            return False
+        now = time.monotonic()
+        for call_sid in [sid for sid, expires in self.reserved_calls.items() if expires <= now]:
+            del self.reserved_calls[call_sid]
+        return self.active_calls + len(self.reserved_calls) >= self.max_connections
+
+    def reserve_call(self, call_sid):
+        """Count an admitted call against max_connections before its media stream arrives"""
+        if self.max_connections:
+            self.reserved_calls[call_sid] = time.monotonic() + CALL_RESERVATION_SECONDS
+
+    def release_call(self, call_sid):
+        self.reserved_calls.pop(call_sid, None)
+
+    def snapshot(self):
+        return {"name": self.name, "active_calls": self.active_calls, "reserved_calls": len(self.reserved_calls),
+                "max_connections": self.max_connections or None}
+
+tenants = {}  # id -> Tenant
+tenants_by_number = {}  # normalized dialled number -> Tenant
+tenants_by_chef = {}  # chef dashboard username -> Tenant
+
+def load_tenants():
+    """
+    Build the tenant registry from TENANTS_FILE (a JSON list of shops). The built-in default
+    tenant uses the settings above and answers numbers not listed anywhere; a file entry with
+    id "default" overrides it. Every other shop needs its own prompt.
+    """
+    loaded = {DEFAULT_TENANT_ID: Tenant(DEFAULT_TENANT_ID, "Melt 8", URDU_PROMPT, chef_username=CHEF_USERNAME, chef_password=CHEF_PASSWORD)}
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding="utf-8") as config_file:
+            entries = json.load(config_file)
+        base_dir = os.path.dirname(os.path.abspath(TENANTS_FILE))
+        for entry in entries:
+            prompt = entry.get("prompt")
+            if prompt is None and entry.get("prompt_file"):
+                with open(os.path.join(base_dir, entry["prompt_file"]), encoding="utf-8") as prompt_file:
+                    prompt = prompt_file.read()
+            is_default = entry["id"] == DEFAULT_TENANT_ID
+            if len(entry["id"]) > TENANT_ID_MAX_LENGTH:
+                raise ValueError(f"Tenant id {entry['id']} is longer than {TENANT_ID_MAX_LENGTH} characters")
+            if not (prompt or "").strip():
+                if not is_default:
+                    # Falling back to the default shop's prompt would greet callers with the wrong name and menu
+                    raise ValueError(f"Tenant {entry['id']} has no prompt (set prompt or a non-empty prompt_file)")
+                prompt = URDU_PROMPT
+            loaded[entry["id"]] = Tenant(
+                entry["id"],
+                entry.get("name", entry["id"]),
+                prompt,
+                voice=entry.get("voice", VOICE),
+                menu=entry.get("menu"),
+                numbers=entry.get("numbers", []),
+                public_base_url=entry.get("public_base_url", PUBLIC_BASE_URL),
+                max_connections=int(entry.get("max_connections", 0)),
+                chef_username=entry.get("chef_username", CHEF_USERNAME if is_default else None),
+                chef_password=entry.get("chef_password", CHEF_PASSWORD if is_default else None)
+            )
+
+    by_number, by_chef = {}, {}
+    for tenant in loaded.values():
+        for number in tenant.numbers:
+            if number in by_number:
+                raise ValueError(f"Number {number} is configured for both {by_number[number].id} and {tenant.id}")
+            by_number[number] = tenant
+        if tenant.chef_username and tenant.chef_password:
+            if tenant.chef_username in by_chef:
+                raise ValueError(f"Chef username {tenant.chef_username} is configured for both {by_chef[tenant.chef_username].id} and {tenant.id}")
+            by_chef[tenant.chef_username] = tenant
+
+    tenants.clear()
+    tenants.update(loaded)
+    tenants_by_number.clear()
+    tenants_by_number.update(by_number)
+    tenants_by_chef.clear()
+    tenants_by_chef.update(by_chef)
+    print(f"🏪 Loaded {len(tenants)} tenant(s): {', '.join(tenants)}")
+
+def resolve_tenant(dialled_number):
+    """Tenant for the dialled Twilio number (the default tenant for unknown numbers)"""
+    return tenants_by_number.get(normalize_number(dialled_number)) or tenants[DEFAULT_TENANT_ID]
 
 # =========================================
 # AUTHENTICATION
 # =========================================
+UNKNOWN_CHEF_PASSWORD = secrets.token_urlsafe(24)  # Compared against when the username matches no shop
+
 def authenticate_chef(credentials: HTTPBasicCredentials = Depends(security)):
     """
     Authenticate chef dashboard access using HTTP Basic Authentication.
-    Returns True if credentials are valid, otherwise raises HTTPException.
+    Returns the Tenant whose chef login matched (dashboards only see that tenant's orders),
+    otherwise raises HTTPException.
     """
-    # Use secrets.compare_digest for constant-time string comparison to prevent timing attacks
-    is_correct_username = secrets.compare_digest(credentials.username, CHEF_USERNAME)
-    is_correct_password = secrets.compare_digest(credentials.password, CHEF_PASSWORD)
+    tenant = tenants_by_chef.get(credentials.username)
+    # Unknown usernames still run a full compare_digest against a random password, so response
+    # timing does not reveal which chef usernames exist
+    expected_password = tenant.chef_password if tenant else UNKNOWN_CHEF_PASSWORD
+    is_correct_username = tenant is not None
+    is_correct_password = secrets.compare_digest(credentials.password.encode("utf-8"), expected_password.encode("utf-8"))
     
     if not (is_correct_username and is_correct_password):
         print(f"❌ Unauthorized chef dashboard access attempt: {credentials.username}")
@@ -162,17 +1477,34 @@ def authenticate_chef(credentials: HTTPBasicCredentials = Depends(security)):
             headers={"WWW-Authenticate": "Basic"}
         )
     
-    print(f"✅ Chef dashboard access granted to: {credentials.username}")
+    print(f"✅ Chef dashboard access granted to: {credentials.username} ({tenant.id})")
+    return tenant
+
+def authenticate_admin(credentials: HTTPBasicCredentials = Depends(security)):
+    """HTTP Basic auth for admin endpoints; they do not exist unless ADMIN_USERNAME/ADMIN_PASSWORD are set"""
+    if not (ADMIN_USERNAME and ADMIN_PASSWORD):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Admin endpoints are disabled")
+    is_correct_username = secrets.compare_digest(credentials.username, ADMIN_USERNAME)
+    is_correct_password = secrets.compare_digest(credentials.password, ADMIN_PASSWORD)
+    if not (is_correct_username and is_correct_password):
+        print(f"❌ Unauthorized admin access attempt: {credentials.username}")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin credentials",
+            headers={"WWW-Authenticate": "Basic"}
+        )
     return True
 
 # =========================================
 # FUNCTION CALL HANDLER
 # =========================================
-async def handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws):
+async def handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws, call_sid=None, tenant_id=DEFAULT_TENANT_ID):
     """
-    Enhanced function call handler with proper error handling and response formatting
+    Enhanced function call handler with proper error handling and response formatting.
+    Returns the saved order ID, or None if no order was saved.
     """
     print(f"🔧 [{connection_id}] Executing function: {function_name} with args: {arguments}")
+    saved_order_id = None
     
     try:
         if function_name == "save_order":
@@ -205,11 +1537,14 @@ async def handle_function_call(connection_id, customer_phone, call_id, function_
                     drink=arguments.get("drink", ""),
                     address=arguments.get("address"),
                     customer_name=arguments.get("customer_name", ""),
-                    customer_phone=customer_phone
+                    customer_phone=customer_phone,
+                    call_sid=call_sid,
+                    tenant_id=tenant_id
                 )
                 
                 # Create function result based on database operation
                 if result:
+                    saved_order_id = result.get("id")
                     function_result = {
                         "type": "conversation.item.create",
                         "item": {
@@ -261,6 +1596,7 @@ async def handle_function_call(connection_id, customer_phone, call_id, function_
         # Request AI to continue/respond
         await openai_ws.send(json.dumps({"type": "response.create"}))
         print(f"✅ [{connection_id}] Function call handling completed")
+        return saved_order_id
         
     except Exception as e:
         print(f"❌ [{connection_id}] Critical error in function call handler: {e}")
@@ -285,21 +1621,12 @@ async def handle_function_call(connection_id, customer_phone, call_id, function_
             await openai_ws.send(json.dumps({"type": "response.create"}))
         except Exception as send_error:
             print(f"❌ [{connection_id}] Failed to send error response: {send_error}")
+        return saved_order_id
 
 # =========================================
-# CHEF DASHBOARD ROUTES  
+# CHEF DASHBOARD ASSETS
 # =========================================
-@app.get("/chef-dashboard")
-async def chef_dashboard(authenticated: bool = Depends(authenticate_chef)):
-    """Serve chef dashboard HTML"""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Melt 8 - Chef Dashboard</title>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
+DASHBOARD_CSS = """
             body { font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5; }
             .header { background: #2c3e50; color: white; padding: 20px; border-radius: 8px; margin-bottom: 20px; }
             .order-card { background: white; border-radius: 8px; padding: 15px; margin-bottom: 15px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
@@ -316,25 +1643,24 @@ async def chef_dashboard(authenticated: bool = Depends(authenticate_chef)):
             .btn-success { background: #27ae60; color: white; }
             .btn-info { background: #3498db; color: white; }
             .refresh-btn { position: fixed; top: 20px; right: 20px; }
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>🍕 Melt 8 - Chef Dashboard</h1>
-            <p>Real-time pizza orders from voice calls</p>
-        </div>
-        
-        <button class="btn btn-info refresh-btn" onclick="location.reload()">🔄 Refresh</button>
-        
-        <div id="orders-container">
-            <p>Loading orders...</p>
-        </div>
-        
-        <script>
+        """
+
+DASHBOARD_JS = """
+            let ordersEtag = null;
+            let currentOrders = [];
+            
             async function loadOrders() {
                 try {
-                    const response = await fetch('/api/orders');
+                    const response = await fetch('/api/orders', {
+                        cache: 'no-store',
+                        headers: ordersEtag ? { 'If-None-Match': ordersEtag } : {}
+                    });
+                    if (response.status === 304) {
+                        return; // Nothing changed since the last poll
+                    }
+                    ordersEtag = response.headers.get('ETag');
                     const orders = await response.json();
+                    currentOrders = orders;
                     
                     const container = document.getElementById('orders-container');
                     if (orders.length === 0) {
@@ -362,7 +1688,9 @@ async def chef_dashboard(authenticated: bool = Depends(authenticate_chef)):
                                 ${order.status === 'new' ? `<button class="btn btn-warning" onclick="updateStatus(${order.id}, 'preparing')">Start Preparing</button>` : ''}
                                 ${order.status === 'preparing' ? `<button class="btn btn-success" onclick="updateStatus(${order.id}, 'ready')">Mark Ready</button>` : ''}
                                 ${order.status === 'ready' ? `<button class="btn btn-info" onclick="updateStatus(${order.id}, 'delivered')">Mark Delivered</button>` : ''}
+                                <button class="btn" onclick="showTranscript(${order.id})">📝 Transcript</button>
                             </div>
+                            <div id="transcript-${order.id}" class="customer-info" style="display: none;"></div>
                         </div>
                     `).join('');
                 } catch (error) {
@@ -383,128 +1711,545 @@ async def chef_dashboard(authenticated: bool = Depends(authenticate_chef)):
                 }
             }
             
+            async function advanceAll(fromStatus, toStatus) {
+                const orderIds = currentOrders.filter(order => order.status === fromStatus).map(order => order.id);
+                if (orderIds.length === 0) {
+                    return;
+                }
+                try {
+                    const response = await fetch('/api/orders/status', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ order_ids: orderIds, from: fromStatus, to: toStatus })
+                    });
+                    const result = await response.json();
+                    if (result.conflicts && result.conflicts.length) {
+                        alert(`${result.conflicts.length} order(s) were already updated elsewhere`);
+                    }
+                    loadOrders();
+                } catch (error) {
+                    alert('Error updating order status');
+                }
+            }
+            
+            async function showTranscript(orderId) {
+                const box = document.getElementById(`transcript-${orderId}`);
+                if (box.style.display === 'block') {
+                    box.style.display = 'none';
+                    return;
+                }
+                try {
+                    const response = await fetch(`/api/orders/${orderId}/transcript`);
+                    const data = await response.json();
+                    box.innerText = data.segments.length
+                        ? data.segments.map(s => `${s.role === 'user' ? '👤' : '🤖'} ${s.text}`).join('\\n')
+                        : 'No transcript recorded for this order.';
+                    box.style.display = 'block';
+                } catch (error) {
+                    alert('Error loading transcript');
+                }
+            }
+            
             // Load orders on page load
             loadOrders();
             
             // Auto-refresh every 10 seconds
             setInterval(loadOrders, 10000);
-        </script>
+        """
+
+DASHBOARD_HTML_TEMPLATE = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>{shop_name} - Chef Dashboard</title>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <link rel="stylesheet" href="/chef-dashboard/static/{css_name}">
+    </head>
+    <body>
+        <div class="header">
+            <h1>🍕 {shop_name} - Chef Dashboard</h1>
+            <p>Real-time pizza orders from voice calls</p>
+        </div>
+        
+        <button class="btn btn-info refresh-btn" onclick="location.reload()">🔄 Refresh</button>
+        
+        <div style="margin-bottom: 20px;">
+            <button class="btn btn-warning" onclick="advanceAll('new', 'preparing')">Start Preparing All New</button>
+            <button class="btn btn-success" onclick="advanceAll('preparing', 'ready')">Mark All Preparing Ready</button>
+        </div>
+        
+        <div id="orders-container">
+            <p>Loading orders...</p>
+        </div>
+        
+        <script src="/chef-dashboard/static/{js_name}"></script>
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+
+def build_static_asset(body, content_type, cache_control):
+    """Encode an asset once at startup: identity, gzip and (if available) brotli bodies plus a strong ETag"""
+    raw = body.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()[:12]
+    return {
+        "digest": digest,
+        "etag": f'"{digest}"',
+        "content_type": content_type,
+        "cache_control": cache_control,
+        "identity": raw,
+        "gzip": gzip.compress(raw, compresslevel=9, mtime=0),
+        "br": brotli.compress(raw, quality=11) if brotli else None
+    }
+
+def static_asset_response(request, asset):
+    """Serve a prebuilt asset, honouring If-None-Match and Accept-Encoding"""
+    headers = {"ETag": asset["etag"], "Cache-Control": asset["cache_control"], "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == asset["etag"]:
+        return Response(status_code=304, headers=headers)
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if asset["br"] and "br" in accept_encoding:
+        headers["Content-Encoding"] = "br"
+        body = asset["br"]
+    elif "gzip" in accept_encoding:
+        headers["Content-Encoding"] = "gzip"
+        body = asset["gzip"]
+    else:
+        body = asset["identity"]
+    return Response(content=body, media_type=asset["content_type"], headers=headers)
+
+# Versioned assets never change under the same name, so they can be cached for a year
+IMMUTABLE_CACHE = "private, max-age=31536000, immutable"
+_css_asset = build_static_asset(DASHBOARD_CSS, "text/css; charset=utf-8", IMMUTABLE_CACHE)
+_js_asset = build_static_asset(DASHBOARD_JS, "application/javascript; charset=utf-8", IMMUTABLE_CACHE)
+DASHBOARD_STATIC_ASSETS = {
+    f"dashboard.{_css_asset['digest']}.css": _css_asset,
+    f"dashboard.{_js_asset['digest']}.js": _js_asset
+}
+def build_dashboard_html_asset(shop_name):
+    """HTML shell for one shop; revalidated on every load so a deploy picks up new asset names"""
+    return build_static_asset(
+        DASHBOARD_HTML_TEMPLATE.format(
+            shop_name=html_escape(shop_name),
+            css_name=f"dashboard.{_css_asset['digest']}.css",
+            js_name=f"dashboard.{_js_asset['digest']}.js"
+        ),
+        "text/html; charset=utf-8",
+        "private, no-cache"
+    )
+
+# Cheap change counter for the orders table; bumped by every write path in this process
+BOOT_ID = uuid.uuid4().hex[:8]
+orders_version = {"value": 0, "modified": time.time()}
+
+def bump_orders_version():
+    orders_version["value"] += 1
+    orders_version["modified"] = time.time()
+
+def orders_etag(tenant_id):
+    return f'W/"orders-{tenant_id}-{BOOT_ID}-{orders_version["value"]}"'
+
+# =========================================
+# CHEF DASHBOARD ROUTES
+# =========================================
+@app.get("/chef-dashboard")
+async def chef_dashboard(request: Request, tenant: Tenant = Depends(authenticate_chef)):
+    """Serve chef dashboard HTML shell (styles and script are served as versioned assets)"""
+    return static_asset_response(request, tenant.dashboard_asset())
+
+@app.get("/chef-dashboard/static/{filename}")
+async def chef_dashboard_static(filename: str, request: Request, tenant: Tenant = Depends(authenticate_chef)):
+    """Serve a versioned, precompressed dashboard asset"""
+    asset = DASHBOARD_STATIC_ASSETS.get(filename)
+    if asset is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Asset not found")
+    return static_asset_response(request, asset)
 
 @app.get("/api/orders")
-async def get_orders(authenticated: bool = Depends(authenticate_chef)):
-    """Get all orders for chef dashboard"""
+async def get_orders(request: Request, response: Response, tenant: Tenant = Depends(authenticate_chef)):
+    """Get all orders for chef dashboard (304 without querying when nothing changed)"""
+    etag = orders_etag(tenant.id)
+    cache_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(orders_version["modified"], usegmt=True),
+        "Cache-Control": "private, no-cache"
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    conn = None
     try:
-        conn = get_db_connection()
+        conn = await acquire_db_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
             SELECT * FROM orders 
+            WHERE tenant_id = %s
             ORDER BY order_time DESC
-        """)
+        """, (tenant.id,))
         
         orders = cursor.fetchall()
         cursor.close()
-        conn.close()
         
+        # Only validators for a successful read, so an error response is never revalidated as current
+        response.headers.update(cache_headers)
         return [dict(order) for order in orders]
     except Exception as e:
         print(f"❌ Error fetching orders: {e}")
+        if conn is not None:
+            conn.rollback()
         return []
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
 
 @app.put("/api/orders/{order_id}/status")
-async def update_order_status(order_id: int, status_data: dict, authenticated: bool = Depends(authenticate_chef)):
-    """Update order status"""
+async def update_order_status(order_id: int, status_data: dict, tenant: Tenant = Depends(authenticate_chef)):
+    """Update order status (must be the next step of new → preparing → ready → delivered)"""
+    new_status = status_data.get("status")
+    expected_status = status_data.get("expected_status", PREVIOUS_ORDER_STATUS.get(new_status))
+    if ORDER_STATUS_TRANSITIONS.get(expected_status) != new_status:
+        return {"success": False, "error": f"Invalid transition: {expected_status} → {new_status}"}
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE orders SET status = %s WHERE id = %s
-        """, (status_data['status'], order_id))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return {"success": True}
+        results = await asyncio.to_thread(apply_status_transitions, [(order_id, expected_status, new_status)], tenant.id)
+        if results and results[0]["applied"]:
+            return {"success": True}
+        current_status = results[0]["current_status"] if results else None
+        return {"success": False, "error": "Order status changed or order not found", "current_status": current_status}
     except Exception as e:
         print(f"❌ Error updating order status: {e}")
         return {"success": False, "error": str(e)}
+
+@app.post("/api/orders/status")
+async def bulk_update_order_status(request_data: dict, tenant: Tenant = Depends(authenticate_chef)):
+    """
+    Apply many validated status transitions in one transaction.
+    Body: {"transitions": [{"id": 1, "from": "new", "to": "preparing"}, ...]}
+       or {"order_ids": [1, 2, 3], "from": "new", "to": "preparing"}
+    """
+    requested = request_data.get("transitions")
+    if requested is None:
+        requested = [
+            {"id": order_id, "from": request_data.get("from"), "to": request_data.get("to")}
+            for order_id in request_data.get("order_ids", [])
+        ]
+
+    transitions = []
+    invalid = []
+    for item in requested:
+        try:
+            order_id = int(item["id"])
+        except (KeyError, TypeError, ValueError):
+            invalid.append({"id": item.get("id") if isinstance(item, dict) else item, "error": "Invalid order id"})
+            continue
+        if ORDER_STATUS_TRANSITIONS.get(item.get("from")) != item.get("to"):
+            invalid.append({"id": order_id, "error": f"Invalid transition: {item.get('from')} → {item.get('to')}"})
+            continue
+        transitions.append((order_id, item["from"], item["to"]))
+
+    updated = []
+    conflicts = []
+    if transitions:
+        try:
+            results = await asyncio.to_thread(apply_status_transitions, transitions, tenant.id)
+        except Exception as e:
+            print(f"❌ Error applying bulk status update: {e}")
+            return {"success": False, "error": str(e)}
+        for row in results:
+            if row["applied"]:
+                updated.append(row["id"])
+            else:
+                conflicts.append({"id": row["id"], "current_status": row["current_status"]})
+
+    print(f"📋 Bulk status update: {len(updated)} updated, {len(conflicts)} conflicts, {len(invalid)} invalid")
+    return {"success": not conflicts and not invalid, "updated": updated, "conflicts": conflicts, "invalid": invalid}
+
+@app.get("/api/reports")
+async def get_sales_report(start: str, end: str, group_by: str = "hour", tenant: Tenant = Depends(authenticate_chef)):
+    """Sales between start and end (ISO dates/times, end exclusive) grouped by hour, day, flavour, size or drink"""
+    if group_by not in REPORT_GROUPINGS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"group_by must be one of: {', '.join(REPORT_GROUPINGS)}")
+    try:
+        start_time = datetime.fromisoformat(start)
+        end_time = datetime.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start and end must be ISO dates, e.g. 2025-01-31")
+
+    try:
+        rows = await asyncio.to_thread(query_sales_report, start_time, end_time, group_by, tenant.id)
+    except Exception as e:
+        print(f"❌ Error building sales report: {e}")
+        return {"error": str(e)}
+    return {
+        "start": start_time.isoformat(),
+        "end": end_time.isoformat(),
+        "group_by": group_by,
+        "totals": {
+            "orders": sum(row["orders"] for row in rows),
+            "delivered": sum(row["delivered"] for row in rows)
+        },
+        "rows": rows
+    }
+
+@app.post("/api/reports/backfill")
+async def backfill_sales_report(request_data: dict = None, tenant: Tenant = Depends(authenticate_chef)):
+    """Rebuild the hourly rollups from raw orders (optionally only between start and end)"""
+    request_data = request_data or {}
+    try:
+        start = datetime.fromisoformat(request_data["start"]) if request_data.get("start") else None
+        end = datetime.fromisoformat(request_data["end"]) if request_data.get("end") else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start and end must be ISO dates")
+    try:
+        rows = await asyncio.to_thread(backfill_sales_rollups, start, end, tenant.id)
+        return {"success": True, "rollup_rows": rows}
+    except Exception as e:
+        print(f"❌ Error backfilling sales rollups: {e}")
+        return {"success": False, "error": str(e)}
+
+@app.get("/api/usage")
+async def get_usage_report(start: str = None, end: str = None, group_by: str = "day", tenant: Tenant = Depends(authenticate_chef)):
+    """
+    Token, turn and duration usage for calls started between start and end (default: the last 7 days),
+    grouped by day, prompt revision or outcome, with totals and per-order cost ratios.
+    Calls still in progress or not yet flushed are not included.
+    """
+    if group_by not in USAGE_GROUPINGS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"group_by must be one of: {', '.join(USAGE_GROUPINGS)}")
+    try:
+        end_time = datetime.fromisoformat(end) if end else datetime.now()
+        start_time = datetime.fromisoformat(start) if start else end_time - timedelta(days=7)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start and end must be ISO dates, e.g. 2025-01-31")
+
+    try:
+        rows = await asyncio.to_thread(query_usage_report, start_time, end_time, group_by, tenant.id)
+    except Exception as e:
+        print(f"❌ Error building usage report: {e}")
+        return {"error": str(e)}
+    totals = {"calls": 0, "orders": 0, **{column: 0 for column in USAGE_COUNTERS}}
+    for row in rows:
+        for column in totals:
+            totals[column] += row[column]
+    return {
+        "start": start_time.isoformat(),
+        "end": end_time.isoformat(),
+        "group_by": group_by,
+        "totals": summarize_usage(totals),
+        "rows": [summarize_usage(row) for row in rows]
+    }
+
+@app.get("/api/orders/prep-stats")
+async def get_prep_stats(hours: int = 24, tenant: Tenant = Depends(authenticate_chef)):
+    """Average seconds spent in each stage for orders placed in the last `hours` hours"""
+    def fetch():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    COUNT(*) AS orders,
+                    AVG(EXTRACT(EPOCH FROM preparing_at - order_time)) AS new_to_preparing,
+                    AVG(EXTRACT(EPOCH FROM ready_at - preparing_at)) AS preparing_to_ready,
+                    AVG(EXTRACT(EPOCH FROM delivered_at - ready_at)) AS ready_to_delivered,
+                    AVG(EXTRACT(EPOCH FROM delivered_at - order_time)) AS total
+                FROM orders
+                WHERE tenant_id = %s AND order_time >= CURRENT_TIMESTAMP - make_interval(hours => %s)
+            """, (tenant.id, hours))
+            row = dict(cursor.fetchone())
+            cursor.close()
+            return row
+        finally:
+            release_db_connection(conn)
+
+    try:
+        stats = await asyncio.to_thread(fetch)
+        return {key: (round(float(value), 1) if value is not None and key != "orders" else value) for key, value in stats.items()}
+    except Exception as e:
+        print(f"❌ Error fetching prep stats: {e}")
+        return {"error": str(e)}
+
+@app.get("/api/orders/{order_id}/transcript")
+async def get_order_transcript(order_id: int, tenant: Tenant = Depends(authenticate_chef)):
+    """Get the call transcript for an order, including segments not yet flushed"""
+    def fetch():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT call_sid FROM orders WHERE id = %s AND tenant_id = %s", (order_id, tenant.id))
+            order = cursor.fetchone()
+            if not order or not order["call_sid"]:
+                return None, []
+            cursor.execute("""
+                SELECT seq, role, text, created_at FROM call_transcripts
+                WHERE call_sid = %s ORDER BY seq
+            """, (order["call_sid"],))
+            segments = [dict(row) for row in cursor.fetchall()]
+            cursor.close()
+            return order["call_sid"], segments
+        finally:
+            release_db_connection(conn)
+
+    try:
+        call_sid, segments = await asyncio.to_thread(fetch)
+    except Exception as e:
+        print(f"❌ Error fetching transcript for order {order_id}: {e}")
+        return {"order_id": order_id, "segments": [], "error": str(e)}
+
+    if call_sid:
+        stored = {segment["seq"] for segment in segments}
+        for row in transcript_writer.pending("call_sid", call_sid):
+            if row["seq"] not in stored:
+                segments.append({key: row[key] for key in ("seq", "role", "text", "created_at")})
+        segments.sort(key=lambda segment: segment["seq"])
+    return {"order_id": order_id, "call_sid": call_sid, "segments": segments}
+
+# =========================================
+# TWIML TEMPLATES
+# =========================================
+TWIML_URL_PLACEHOLDER = "__TWIML_URL__"
+twiml_templates = {}
+
+def build_twiml_templates():
+    """Render each fixed TwiML document once; per call only the URL is substituted"""
+    from twilio.twiml.voice_response import VoiceResponse, Connect
+
+    not_configured = VoiceResponse()
+    not_configured.say("Webhook is working! However, the AI voice assistant is not fully configured yet. Please add your API keys to enable voice features.")
+
+    hold = VoiceResponse()
+    hold.say("All our lines are busy right now. Please stay on the line, we will connect you shortly.")
+    hold.pause(length=HOLD_SECONDS)
+    hold.redirect(TWIML_URL_PLACEHOLDER, method="POST")
+
+    reject = VoiceResponse()
+    reject.say("Sorry, we are receiving too many calls right now. Please call again in a few minutes. Thank you!")
+    reject.hangup()
+
+    connect_call = VoiceResponse()
+    connect_call.say("Please wait while we connect your call to the AI voice assistant.")
+    connect_call.pause(length=1)
+    connect_call.say("Okay, you can start talking!")
+    connect = Connect()
+    connect.stream(url=TWIML_URL_PLACEHOLDER)
+    connect_call.append(connect)
+
+    return {
+        "not_configured": str(not_configured),
+        "hold": str(hold),
+        "reject": str(reject),
+        "connect": str(connect_call)
+    }
+
+def render_twiml(name, url=""):
+    if not twiml_templates:
+        twiml_templates.update(build_twiml_templates())
+    return twiml_templates[name].replace(TWIML_URL_PLACEHOLDER, xml_escape(url, {'"': "&quot;"}))
+
 # =========================================
 # TWILIO VOICE WEBHOOK
 # =========================================
+# HMAC-SHA1 keyed with the auth token once; each request copies the keyed state
+twilio_signature_key = hmac.new(TWILIO_AUTH_TOKEN.encode(), digestmod=hashlib.sha1) if TWILIO_AUTH_TOKEN else None
+webhook_stats = {"served": 0, "invalid_signature": 0}
+
+def compute_twilio_signature(url, params):
+    """
+    Twilio's scheme: HMAC-SHA1 over the full URL followed by each distinct POST (name, value)
+    pair in sorted order. Blank values are signed too, so params must keep them.
+    """
+    mac = twilio_signature_key.copy()
+    mac.update(url.encode())
+    for name, value in sorted(set(params)):
+        mac.update(name.encode())
+        mac.update(value.encode())
+    return base64.b64encode(mac.digest()).decode()
+
+def valid_twilio_signature(url, params, signature):
+    if not signature:
+        return False
+    return hmac.compare_digest(compute_twilio_signature(url, params), signature)
+
+def check_twilio_signature_scheme():
+    """Compare compute_twilio_signature with Twilio's own validator on blank and repeated params"""
+    from twilio.request_validator import RequestValidator
+    from starlette.datastructures import ImmutableMultiDict
+    url = "https://example.com/incoming-call?hold_attempt=1"
+    params = [("CallSid", "CA123"), ("From", "+923001112222"), ("CallerCity", ""), ("FromState", ""),
+              ("StirVerstat", "TN-Validation-Passed-C"), ("Forwarded", "b"), ("Forwarded", "a"), ("Forwarded", "a")]
+    expected = RequestValidator(TWILIO_AUTH_TOKEN).compute_signature(url, ImmutableMultiDict(params))
+    if compute_twilio_signature(url, params) != expected:
+        print("❌ Twilio signature check does not match twilio.request_validator - signed webhooks will be rejected")
+        return False
+    return True
+
+def clean_caller_number(caller_phone):
+    """Strip the WhatsApp prefix, +1 on US numbers and a leading +"""
+    if caller_phone.startswith("whatsapp:"):
+        caller_phone = caller_phone[9:]
+    if caller_phone.startswith("+1") and len(caller_phone) == 12:
+        return caller_phone[2:]
+    if caller_phone.startswith("+"):
+        return caller_phone[1:]
+    return caller_phone
+
 @app.api_route("/incoming-call", methods=["GET", "POST"])
 async def handle_incoming_call(request: Request):
-    """Handle Twilio webhook and respond with TwiML to connect audio stream."""
-    response = VoiceResponse()
+    """
+    Handle Twilio webhook and respond with TwiML to connect audio stream.
+    Hot path: raw body parsed with parse_qsl, signature checked with the cached HMAC key,
+    TwiML rendered from the prebuilt templates and a single log line per call.
+    """
+    # POST is what Twilio sends; GET (query parameters only) is kept for testing
+    form_params = parse_qsl((await request.body()).decode(), keep_blank_values=True) if request.method == "POST" else []
+    params = dict(form_params) if request.method == "POST" else request.query_params
+
+    if twilio_signature_key is not None:
+        query = request.url.query
+        signed_url = f"https://{request.headers.get('host', '')}{request.url.path}{'?' + query if query else ''}"
+        if not valid_twilio_signature(signed_url, form_params, request.headers.get("x-twilio-signature")):
+            # Counted, not logged: a flood of forged requests should not also flood the logs
+            webhook_stats["invalid_signature"] += 1
+            return Response(status_code=status.HTTP_403_FORBIDDEN)
 
     if not API_KEYS_CONFIGURED:
-        response.say("Webhook is working! However, the AI voice assistant is not fully configured yet. Please add your API keys to enable voice features.")
-        return HTMLResponse(content=str(response), media_type="application/xml")
+        return Response(content=render_twiml("not_configured"), media_type="application/xml")
 
-    # Extract customer phone number from Twilio webhook data
-    form_data = None
-    call_sid = "unknown"
-    
+    call_sid = params.get("CallSid") or "unknown"
+    caller_phone = clean_caller_number(params.get("From") or "Unknown")
+    phone_registry[call_sid] = caller_phone
+    tenant = resolve_tenant(params.get("To"))
+
+    # Admission control: hold, reject or throttle when upstream headroom is low or the shop is at its call limit
     try:
-        if request.method == "POST":
-            form_data = await request.form()
-            caller_phone_raw = form_data.get("From", "Unknown")
-            call_sid = form_data.get("CallSid", "unknown")
-            # Ensure we have a string, not UploadFile
-            caller_phone = str(caller_phone_raw) if caller_phone_raw else "Unknown"
-        else:
-            # For GET requests (testing), use query parameter
-            caller_phone = request.query_params.get("From", "Unknown")
-            call_sid = request.query_params.get("CallSid", "unknown")
-        
-        # Clean up phone number format (handle WhatsApp format and regular formats)
-        if isinstance(caller_phone, str) and caller_phone != "Unknown":
-            # Handle WhatsApp format: whatsapp:+923270737372
-            if caller_phone.startswith("whatsapp:"):
-                caller_phone = caller_phone[9:]  # Remove "whatsapp:" prefix
-                print(f"🟢 WhatsApp call detected, extracted number: {caller_phone}")
-            
-            # Now handle regular phone number prefixes
-            if caller_phone.startswith("+1") and len(caller_phone) == 12:
-                caller_phone = caller_phone[2:]  # Remove +1 prefix
-            elif caller_phone.startswith("+"):
-                caller_phone = caller_phone[1:]  # Remove + prefix
-            
-        print(f"📞 Incoming call from: {caller_phone}")
-        
-        # Store phone number for this call session
-        phone_registry[call_sid] = caller_phone
-        print(f"📝 Stored phone {caller_phone} for call session {call_sid}")
-        
-    except Exception as e:
-        print(f"❌ Error extracting phone number: {e}")
-        caller_phone = "Unknown"
+        hold_attempt = int(request.query_params.get("hold_attempt", "0"))
+    except ValueError:
+        hold_attempt = 0
+    decision = rate_limit_tracker.admission_decision(hold_attempt)
+    if decision in ("admit", "throttle") and tenant.at_capacity():
+        decision = "queue" if hold_attempt < HOLD_MAX_ATTEMPTS else "reject"
+    admission_counts[decision] += 1
+    if decision != "admit":
+        print(f"🚦 Admission for {call_sid} ({tenant.id}): {decision} (headroom {rate_limit_tracker.headroom():.2f}, "
+              f"{tenant.active_calls}+{len(tenant.reserved_calls)}/{tenant.max_connections or '∞'} calls, hold attempt {hold_attempt})")
+
+    if decision == "queue":
+        return Response(content=render_twiml("hold", f"/incoming-call?hold_attempt={hold_attempt + 1}"), media_type="application/xml")
+
+    if decision == "reject":
+        return Response(content=render_twiml("reject"), media_type="application/xml")
+
+    tenant.reserve_call(call_sid)
+    if startup_timings["first_call_s"] is None:
+        startup_timings["first_call_s"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+        print(f"⏱️ Time to first served call: {startup_timings['first_call_s']}s after process start")
 
-    response.say("Please wait while we connect your call to the AI voice assistant.")
-    response.pause(length=1)
-    response.say("Okay, you can start talking!")
-    
     # Use fixed deployment URL for WebSocket (not workflow preview URL)
     # Pass phone number in URL to avoid cross-process memory issues
-    import urllib.parse
-    encoded_phone = urllib.parse.quote(caller_phone)
-    websocket_url = f"wss://{PUBLIC_BASE_URL}/media-stream?call_sid={call_sid}&customer_phone={encoded_phone}"
-    print(f"🔗 Generated WebSocket URL: {websocket_url}")
-    
-    connect = Connect()
-    connect.stream(url=websocket_url)
-    response.append(connect)
-    
-    # Debug: Show the final TwiML response
-    twiml_response = str(response)
-    print(f"📋 TwiML Response: {twiml_response}")
-    
-    return HTMLResponse(content=twiml_response, media_type="application/xml")
+    websocket_url = (f"wss://{tenant.public_base_url}/media-stream?call_sid={quote(call_sid)}"
+                     f"&customer_phone={quote(caller_phone)}&tenant={quote(tenant.id)}")
+    webhook_stats["served"] += 1
+    print(f"📞 Incoming call {call_sid} from {caller_phone} for {tenant.id}")
+    return Response(content=render_twiml("connect", websocket_url), media_type="application/xml")
 # =========================================
 # MEDIA STREAM HANDLER
 # =========================================
@@ -521,7 +2266,8 @@ async def handle_media_stream(websocket: WebSocket):
     try:
         # Extract call_sid from WebSocket query parameters
         if hasattr(websocket, 'query_params'):
-            call_sid = websocket.query_params.get('call_sid', 'unknown')
+            # Unauthenticated query parameter: keep it within the call tables' column width
+            call_sid = websocket.query_params.get('call_sid', 'unknown')[:CALL_SID_MAX_LENGTH]
             print(f"📞 [{connection_id}] Call SID: {call_sid}")
             
             # Get phone number from URL parameters first (reliable), then fall back to registry
@@ -542,25 +2288,26 @@ async def handle_media_stream(websocket: WebSocket):
         print(f"❌ [{connection_id}] Error in phone extraction: {e}")
     
     print(f"📱 [{connection_id}] FINAL customer phone: {customer_phone}")
+    tenant = tenants.get(websocket.query_params.get("tenant", DEFAULT_TENANT_ID)) or tenants[DEFAULT_TENANT_ID]
     
     await websocket.accept()
 
     if not API_KEYS_CONFIGURED:
         print(f"❌ [{connection_id}] API keys not configured - closing WebSocket connection")
+        tenant.release_call(call_sid)
         await websocket.close()
         return
     try:
-        async with websockets.connect(
-            "wss://api.openai.com/v1/realtime?model=gpt-4o-mini-realtime-preview-2024-12-17",
-            additional_headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "OpenAI-Beta": "realtime=v1"
-            }
-        ) as openai_ws:
+        silence_gate = audio_codec.SilenceGate(SILENCE_HANGOVER_MS, SILENCE_PREFIX_MS, SILENCE_KEEPALIVE_MS) if SILENCE_SUPPRESSION else None
+        call_state = CallState()
+        call_usage = CallUsage()
+        async with UpstreamConnection(connection_id, call_state, tenant) as openai_ws:
             try:
                 # Only increment counter after successful connections
                 active_connections += 1
-                print(f"🔗 [{connection_id}] Connected successfully (Active: {active_connections})")
+                tenant.active_calls += 1
+                tenant.release_call(call_sid)
+                print(f"🔗 [{connection_id}] Connected successfully for {tenant.id} (Active: {active_connections})")
                 
                 # CRITICAL FIX: Do not send session update immediately - wait for session.created first
                 session_configured = False
@@ -568,6 +2315,28 @@ async def handle_media_stream(websocket: WebSocket):
                 stream_sid = None
                 drop_audio = False
                 ai_speaking = False
+                output_token_cap = DEFAULT_MAX_OUTPUT_TOKENS
+                transcoder = audio_codec.CallTranscoder() if AUDIO_MODE == "pcm16" else None
+                call_started = time.monotonic()
+                transcript_seq = 0
+                event_seq = 0
+
+                def record_transcript(role, text):
+                    """Queue a transcript segment for the background writer"""
+                    nonlocal transcript_seq
+                    text = (text or "").strip()
+                    if text:
+                        transcript_seq += 1
+                        transcript_writer.add((call_sid[:CALL_SID_MAX_LENGTH], transcript_seq, role[:TRANSCRIPT_ROLE_MAX_LENGTH],
+                                               text, datetime.now().isoformat()))
+
+                def record_event(event_type):
+                    """Queue an entry in this call's event timeline (offset from call start)"""
+                    nonlocal event_seq
+                    event_seq += 1
+                    offset_ms = int((time.monotonic() - call_started) * 1000)
+                    event_writer.add((call_sid[:CALL_SID_MAX_LENGTH], event_seq, event_type[:EVENT_TYPE_MAX_LENGTH],
+                                      offset_ms, datetime.now().isoformat()))
                 
                 def _ulaw_to_linear(b):
                     """Convert G.711 µ-law to linear PCM"""
@@ -625,7 +2394,7 @@ async def handle_media_stream(websocket: WebSocket):
                         return False
                         
                 async def receive_from_twilio():
-                    nonlocal stream_sid, drop_audio, ai_speaking, customer_phone
+                    nonlocal stream_sid, drop_audio, ai_speaking, customer_phone, call_sid
                     try:
                         async for message in websocket.iter_text():
                             data = json.loads(message)
@@ -636,6 +2405,8 @@ async def handle_media_stream(websocket: WebSocket):
                                     if detect_strong_user_speech(data["media"]["payload"]):
                                         print(f"🎤 [{connection_id}] STRONG user interruption detected during AI speech!")
                                         drop_audio = True
+                                        if transcoder:
+                                            transcoder.reset_output()
                                         ai_speaking = False
                                         # Send cancel to OpenAI to stop generation
                                         try:
@@ -648,19 +2419,32 @@ async def handle_media_stream(websocket: WebSocket):
                                 
                                 # CRITICAL FIX: Only send audio when AI is NOT speaking
                                 if not ai_speaking:
-                                    audio_append = {
-                                        "type": "input_audio_buffer.append",
-                                        "audio": data["media"]["payload"]
-                                    }
-                                    await openai_ws.send(json.dumps(audio_append))
+                                    payloads = [data["media"]["payload"]]
+                                    if silence_gate or transcoder:
+                                        frames = [base64.b64decode(payloads[0])]
+                                        if silence_gate:
+                                            frames = silence_gate.process(frames[0])
+                                        if transcoder:
+                                            frames = [transcoder.twilio_to_upstream(frame) for frame in frames]
+                                        payloads = [base64.b64encode(frame).decode("utf-8") for frame in frames]
+                                    for payload in payloads:
+                                        audio_append = {
+                                            "type": "input_audio_buffer.append",
+                                            "audio": payload
+                                        }
+                                        await openai_ws.send(json.dumps(audio_append))
+                            elif data["event"] == "stop":
+                                record_event("twilio.stop")
                             elif data["event"] == "start":
                                 stream_sid = data["start"]["streamSid"]
+                                record_event("twilio.start")
                                 print(f"📞 [{connection_id}] Stream started: {stream_sid}")
                                 
                                 # CRITICAL FIX: Extract CallSid from Twilio start event
                                 twilio_call_sid = data["start"].get("callSid")
                                 if twilio_call_sid:
                                     print(f"📞 [{connection_id}] CallSid from start event: {twilio_call_sid}")
+                                    call_sid = twilio_call_sid[:CALL_SID_MAX_LENGTH]
                                     
                                     # Look up phone number in registry using the CallSid
                                     if twilio_call_sid in phone_registry:
@@ -673,19 +2457,55 @@ async def handle_media_stream(websocket: WebSocket):
                                     print(f"❌ [{connection_id}] No CallSid in start event data")
                     except Exception as e:
                         print(f"❌ [{connection_id}] Error receiving from Twilio: {e}")
+                    finally:
+                        # Caller hung up - stop the upstream so send_to_twilio does not try to resume
+                        await openai_ws.close()
                 async def send_to_twilio():
-                    nonlocal stream_sid, drop_audio, ai_speaking, session_configured
+                    nonlocal stream_sid, drop_audio, ai_speaking, session_configured, output_token_cap
                     try:
                         async for openai_message in openai_ws:
                             response = json.loads(openai_message)
                             if response["type"] in LOG_EVENT_TYPES:
                                 print(f"Event: {response['type']}", response)
+
+                            # Upstream dropped and was resumed with replayed state
+                            if response["type"] == "upstream.reconnected":
+                                ai_speaking = False
+                                drop_audio = False
+                                output_token_cap = rate_limit_tracker.max_output_tokens()
+                                continue
+
+                            # Event timeline (per-chunk deltas are too chatty to keep)
+                            if not response["type"].endswith(".delta"):
+                                record_event(response["type"])
+
+                            # Track transcript for replay after a reconnect and persist it
+                            if response["type"] == "conversation.item.input_audio_transcription.completed":
+                                call_state.add_turn("user", response.get("transcript"))
+                                record_transcript("user", response.get("transcript"))
+                            elif response["type"] == "response.audio_transcript.done":
+                                call_state.add_turn("assistant", response.get("transcript"))
+                                record_transcript("assistant", response.get("transcript"))
+
+                            # Feed the shared tracker and tighten/relax this call's response cap
+                            if response["type"] == "rate_limits.updated":
+                                rate_limit_tracker.update(response.get("rate_limits"))
+                                new_cap = rate_limit_tracker.max_output_tokens()
+                                if session_configured and new_cap != output_token_cap:
+                                    output_token_cap = new_cap
+                                    print(f"🚦 [{connection_id}] Adjusting max_response_output_tokens to {new_cap}")
+                                    await openai_ws.send(json.dumps({
+                                        "type": "session.update",
+                                        "session": {"max_response_output_tokens": new_cap}
+                                    }))
+                                continue
                             
                             # CRITICAL FIX: Send session update after receiving session.created
                             if response["type"] == "session.created" and not session_configured:
                                 print(f"✅ [{connection_id}] session.created received, now sending our configuration...")
                                 try:
-                                    await send_session_update(openai_ws)
+                                    output_token_cap = rate_limit_tracker.max_output_tokens()
+                                    await send_session_update(openai_ws, tenant, max_output_tokens=output_token_cap)
                                     session_configured = True
                                     print(f"📤 [{connection_id}] Session update sent successfully, waiting for session.updated...")
                                 except Exception as e:
@@ -702,10 +2522,11 @@ async def handle_media_stream(websocket: WebSocket):
                                 
                                 # Check if our instructions were applied
                                 instructions = session_data.get("instructions", "")
-                                if "Melt 8" in instructions and "اردو" in instructions:
-                                    print(f"✅ [{connection_id}] Urdu pizza prompt applied successfully!")
+                                prompt_applied = instructions.strip() == tenant.prompt.strip()
+                                if prompt_applied:
+                                    print(f"✅ [{connection_id}] {tenant.name} prompt applied successfully!")
                                 else:
-                                    print(f"❌ [{connection_id}] CRITICAL: Urdu prompt NOT applied!")
+                                    print(f"❌ [{connection_id}] CRITICAL: {tenant.name} prompt NOT applied!")
                                     print(f"🔍 [{connection_id}] Received instructions: {instructions[:100]}...")
                                 
                                 # Check if save_order tool was registered
@@ -718,8 +2539,8 @@ async def handle_media_stream(websocket: WebSocket):
                                     print(f"🔍 [{connection_id}] Received tools: {[t.get('name', 'unnamed') for t in tools]}")
                                 
                                 # Overall session configuration status
-                                if "Melt 8" in instructions and save_order_found:
-                                    print(f"🎉 [{connection_id}] Session configured perfectly - Ready for Urdu pizza orders!")
+                                if prompt_applied and save_order_found:
+                                    print(f"🎉 [{connection_id}] Session configured perfectly - Ready for {tenant.name} orders!")
                                 else:
                                     print(f"⚠️ [{connection_id}] Session configuration FAILED - Check above errors")
                             
@@ -747,6 +2568,7 @@ async def handle_media_stream(websocket: WebSocket):
 
                             # Reset drop flag when user finishes speaking and AI can respond
                             elif response["type"] == "input_audio_buffer.committed":
+                                call_usage.user_turns += 1
                                 print(f"🔊 [{connection_id}] User audio committed - AI can respond")
                                 drop_audio = False
                                 # Only set ai_speaking to false if we're not currently generating
@@ -757,6 +2579,7 @@ async def handle_media_stream(websocket: WebSocket):
                             elif response["type"] == "response.function_call_arguments.delta":
                                 # Function call in progress, log with details
                                 delta_content = response.get('delta', '')
+                                call_state.add_arguments_delta(response.get("call_id"), delta_content)
                                 print(f"🔧 [{connection_id}] Function call streaming delta: {delta_content[:100]}...")
                             
                             elif response["type"] == "response.function_call_arguments.done":
@@ -786,8 +2609,13 @@ async def handle_media_stream(websocket: WebSocket):
                                         print(f"❌ [{connection_id}] Failed to parse function arguments: {e}")
                                         arguments = {}
                                     
+                                    if function_name == "save_order":
+                                        call_state.set_pending_order(call_id, arguments)
+
                                     # Use the enhanced function call handler
-                                    await handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws)
+                                    saved_order_id = await handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws, call_sid, tenant.id)
+                                    if saved_order_id:
+                                        call_state.saved_order_id = saved_order_id
                                         
                                 except Exception as e:
                                     print(f"❌ [{connection_id}] Error processing function_call_arguments.done: {e}")
@@ -797,6 +2625,7 @@ async def handle_media_stream(websocket: WebSocket):
                             # Handle response completion and check for function calls
                             elif response["type"] == "response.done":
                                 ai_speaking = False
+                                call_usage.add_response(response.get("response") or {})
                                 if response.get("response", {}).get("status") == "cancelled":
                                     print(f"❌ [{connection_id}] Response cancelled")
                                 else:
@@ -828,7 +2657,9 @@ async def handle_media_stream(websocket: WebSocket):
                                                             arguments = {}
                                                         
                                                         # Use the enhanced function call handler
-                                                        await handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws)
+                                                        saved_order_id = await handle_function_call(connection_id, customer_phone, call_id, function_name, arguments, openai_ws, call_sid, tenant.id)
+                                                        if saved_order_id:
+                                                            call_state.saved_order_id = saved_order_id
                                     except Exception as e:
                                         print(f"❌ [{connection_id}] Error processing function calls from response.done: {e}")
                             # Process audio deltas with responsive yielding
@@ -841,6 +2672,8 @@ async def handle_media_stream(websocket: WebSocket):
 
                                     # Decode audio data
                                     audio_data = base64.b64decode(response["delta"])
+                                    if transcoder:
+                                        audio_data = transcoder.upstream_to_twilio(audio_data)
 
                                     # Split into 20ms frames (160 bytes for G.711 µ-law at 8kHz)
                                     frame_size = 160
@@ -872,6 +2705,9 @@ async def handle_media_stream(websocket: WebSocket):
 
                                 except Exception as e:
                                     print(f"❌ [{connection_id}] Error processing audio delta: {e}")
+                        # Upstream could not be resumed - end the Twilio side as well
+                        if openai_ws.gave_up:
+                            await websocket.close()
                     except Exception as e:
                         print(f"❌ [{connection_id}] Error from OpenAI: {e}")
                 
@@ -880,16 +2716,31 @@ async def handle_media_stream(websocket: WebSocket):
                 print(f"❌ [{connection_id}] Connection error: {e}")
             finally:
                 active_connections -= 1
+                tenant.active_calls -= 1
+                usage_writer.add(call_usage.row(call_sid, tenant, call_state.saved_order_id))
+                print(f"🧾 [{connection_id}] Usage: {call_usage.responses} responses, {call_usage.user_turns} user turns, "
+                      f"in {call_usage.input_text_tokens}+{call_usage.input_audio_tokens} / out {call_usage.output_text_tokens}+{call_usage.output_audio_tokens} tokens (text+audio)")
+                if silence_gate:
+                    gate_stats = silence_gate.stats()
+                    # Base64 payload of a suppressed frame (PCM16 24 kHz frames are 6x larger)
+                    frame_bytes = 160 * (6 if AUDIO_MODE == "pcm16" else 1)
+                    bytes_saved = gate_stats["suppressed"] * 4 * ((frame_bytes + 2) // 3)
+                    silence_totals["forwarded"] += gate_stats["forwarded"]
+                    silence_totals["suppressed"] += gate_stats["suppressed"]
+                    silence_totals["upstream_bytes_saved"] += bytes_saved
+                    print(f"🔇 [{connection_id}] Silence gate: {gate_stats['forwarded']} forwarded, {gate_stats['suppressed']} suppressed ({bytes_saved} bytes saved)")
                 print(f"🔌 [{connection_id}] Connection closed (Active: {active_connections})")
     except Exception as e:
         print(f"❌ [{connection_id}] Failed to connect to OpenAI: {e}")
+        tenant.release_call(call_sid)
+        if note_upstream_connect_failure(e):
+            print(f"🚦 [{connection_id}] Upstream rate limited - holding new callers")
         await websocket.close(code=1011, reason="Upstream connect failed")
 # =========================================
 # SESSION UPDATE WITH PROMPT ID + VERSION
 # =========================================
-async def send_session_update(openai_ws):
-    # Urdu pizza ordering prompt
-    urdu_prompt = """
+# Urdu pizza ordering prompt
+URDU_PROMPT = """
 آپ Melt 8 پیزا شاپ کے سیلز ایجنٹ ہیں۔ ہمیشہ اردو میں بات کریں۔
 
 🚨 CRITICAL RULES - NEVER BREAK THESE:
@@ -931,74 +2782,81 @@ You: "آرڈر کنفرم! 30 منٹ میں آئے گا"
 
 Remember: ADDRESS IS MANDATORY! Never skip it!"""
 
+def build_save_order_tool(menu):
+    """save_order tool schema; a tenant menu turns flavours, sizes and drinks into enums"""
+    tool = {
+        "type": "function",
+        "name": "save_order",
+        "description": "Save a completed pizza order to the database.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "flavour": {
+                    "type": "string",
+                    "description": "Pizza flavour chosen by the customer (e.g., Pepperoni, Veggie)."
+                },
+                "size": {
+                    "type": "string",
+                    "description": "Pizza size.",
+                    "enum": ["Small", "Medium", "Large"]
+                },
+                "drink": {
+                    "type": "string",
+                    "description": "Optional drink choice. If none, send an empty string."
+                },
+                "address": {
+                    "type": "string",
+                    "description": "Delivery address (street, area, city)."
+                },
+                "customer_name": {
+                    "type": "string",
+                    "description": "Customer name."
+                }
+            },
+            "required": ["flavour", "size", "address"]
+        }
+    }
+    properties = tool["parameters"]["properties"]
+    if menu.get("flavours"):
+        properties["flavour"]["enum"] = list(menu["flavours"])
+    if menu.get("sizes"):
+        properties["size"]["enum"] = list(menu["sizes"])
+    if menu.get("drinks"):
+        properties["drink"]["enum"] = list(menu["drinks"]) + [""]
+    return tool
+
+def build_session_update(tenant, max_output_tokens):
     # CRITICAL FIX: Proper OpenAI Realtime API session configuration
-    session_update = {
+    return {
         "type": "session.update",
         "session": {
             "modalities": ["text", "audio"],
-            "instructions": urdu_prompt,
-            "voice": VOICE,
-            "input_audio_format": "g711_ulaw",  # CRITICAL: Set correct audio format for Twilio
-            "output_audio_format": "g711_ulaw", # CRITICAL: Match Twilio's expected format
+            "instructions": tenant.prompt,
+            "voice": tenant.voice,
+            "input_audio_format": AUDIO_MODE,  # g711_ulaw matches Twilio; pcm16 is transcoded per call
+            "output_audio_format": AUDIO_MODE,
             "input_audio_transcription": {
                 "model": "whisper-1"
             },
             "turn_detection": {
                 "type": "server_vad",
                 "threshold": 0.7,  # CRITICAL FIX: Higher threshold to prevent AI voice triggering
-                "prefix_padding_ms": 500,  # More padding to avoid cutting user speech
-                "silence_duration_ms": 800  # Longer silence required to prevent false triggers from AI voice
+                "prefix_padding_ms": VAD_PREFIX_PADDING_MS,  # More padding to avoid cutting user speech
+                "silence_duration_ms": VAD_SILENCE_DURATION_MS  # Longer silence required to prevent false triggers from AI voice
             },
-            "tools": [
-                {
-                    "type": "function",
-                    "name": "save_order",
-                    "description": "Save a completed pizza order to the database.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "flavour": {
-                                "type": "string",
-                                "description": "Pizza flavour chosen by the customer (e.g., Pepperoni, Veggie)."
-                            },
-                            "size": {
-                                "type": "string",
-                                "description": "Pizza size.",
-                                "enum": ["Small", "Medium", "Large"]
-                            },
-                            "drink": {
-                                "type": "string",
-                                "description": "Optional drink choice. If none, send an empty string."
-                            },
-                            "address": {
-                                "type": "string",
-                                "description": "Delivery address (street, area, city)."
-                            },
-                            "customer_name": {
-                                "type": "string",
-                                "description": "Customer name."
-                            }
-                        },
-                        "required": ["flavour", "size", "address"]
-                    }
-                }
-            ],
+            "tools": [build_save_order_tool(tenant.menu)],
             "tool_choice": "auto",
             "temperature": 0.8,
-            "max_response_output_tokens": 4096
+            "max_response_output_tokens": max_output_tokens
         }
     }
-    
-    print(f"🔧 CRITICAL FIX: Sending corrected session update for Twilio audio compatibility")
-    print("Session config summary:")
-    print(f"- Instructions: {len(urdu_prompt)} chars (Urdu pizza prompt)")
-    print(f"- Tools: {len(session_update['session']['tools'])} function(s)")
-    print(f"- Voice: {VOICE}")
-    print(f"- AUDIO FORMAT: {session_update['session']['input_audio_format']} -> {session_update['session']['output_audio_format']}")
-    print(f"- Tool choice: {session_update['session']['tool_choice']}")
+
+async def send_session_update(openai_ws, tenant, max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS):
+    payload = tenant.session_payload(max_output_tokens)
+    print(f"🔧 Sending session update for {tenant.id}: {len(tenant.prompt)} char prompt, voice {tenant.voice}, audio {AUDIO_MODE}, max output tokens {max_output_tokens}")
     
     try:
-        await openai_ws.send(json.dumps(session_update))
+        await openai_ws.send(payload)
         print("✅ Session update sent successfully")
         
         # Wait briefly for session confirmation
@@ -1009,8 +2867,362 @@ Remember: ADDRESS IS MANDATORY! Never skip it!"""
         import traceback
         traceback.print_exc()
         raise e
+# =========================================
+# HEALTH CHECKS
+# =========================================
+def upstream_address():
+    """(host, port, tls) of OPENAI_REALTIME_URL; ws:// and explicit ports are honoured (e.g. a local fake upstream)"""
+    parts = urlsplit(OPENAI_REALTIME_URL)
+    tls = parts.scheme in ("wss", "https")
+    return parts.hostname, parts.port or (443 if tls else 80), tls
+
+
+class HealthMonitor:
+    """
+    Cached dependency health behind /healthz and /readyz.
+    Background tasks measure DB round-trip time, pool saturation and upstream connect latency,
+    and event-loop lag comes from loop_watchdog; probes only read the latest results and never touch the DB.
+    """
+
+    def __init__(self):
+        self.database = {"ok": None, "rtt_ms": None, "error": None, "checked_at": None}
+        self.pool = {"in_use": 0, "size": DB_POOL_MAX, "saturation": 0.0}
+        self.upstream = {"ok": None, "connect_ms": None, "error": None, "checked_at": None, "source": None}
+        self.db_check = None
+        self.tasks = []
+
+    def check_database(self):
+        """Time one round-trip on a pooled connection (runs in a worker thread)"""
+        conn = get_db_connection()
+        try:
+            started = time.perf_counter()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            return (time.perf_counter() - started) * 1000
+        finally:
+            release_db_connection(conn)
+
+    def record_database(self, rtt_ms=None, error=None):
+        self.database.update(ok=error is None, rtt_ms=None if rtt_ms is None else round(rtt_ms, 1),
+                             error=error, checked_at=time.monotonic())
+
+    def record_upstream_connect(self, connect_ms=None, error=None, source="call"):
+        """Record an upstream connect, either from the probe or from a real call"""
+        self.upstream.update(ok=error is None, connect_ms=None if connect_ms is None else round(connect_ms, 1),
+                             error=error, checked_at=time.monotonic(), source=source)
+
+    def update_pool_usage(self):
+        if db_pool is None:
+            return
+        # psycopg2 pools expose no public counter; _used holds the checked-out connections
+        in_use = len(db_pool._used)
+        self.pool = {"in_use": in_use, "size": db_pool.maxconn, "saturation": round(in_use / db_pool.maxconn, 3)}
+
+    async def database_loop(self):
+        while True:
+            self.update_pool_usage()
+            if self.db_check is not None and not self.db_check.done():
+                # A hung check keeps its connection; do not pile more threads on top of it
+                self.record_database(error="previous check still running")
+            else:
+                self.db_check = asyncio.ensure_future(asyncio.to_thread(self.check_database))
+                done, _ = await asyncio.wait({self.db_check}, timeout=HEALTH_CHECK_TIMEOUT)
+                if not done:
+                    self.record_database(error=f"timed out after {HEALTH_CHECK_TIMEOUT}s")
+                elif self.db_check.exception() is not None:
+                    self.record_database(error=str(self.db_check.exception()).strip() or type(self.db_check.exception()).__name__)
+                else:
+                    self.record_database(rtt_ms=self.db_check.result())
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+    async def upstream_loop(self):
+        host, port, tls = upstream_address()
+        while True:
+            started = time.perf_counter()
+            try:
+                # Connect (plus TLS handshake for wss) only: a full realtime session per probe would count against rate limits
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=tls or None, server_hostname=host if tls else None),
+                    timeout=HEALTH_CHECK_TIMEOUT
+                )
+                self.record_upstream_connect((time.perf_counter() - started) * 1000, source="probe")
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+            except Exception as e:
+                self.record_upstream_connect(error=str(e).strip() or type(e).__name__, source="probe")
+            await asyncio.sleep(HEALTH_UPSTREAM_CHECK_INTERVAL)
+
+    def start(self):
+        if DATABASE_URL:
+            self.tasks.append(asyncio.create_task(self.database_loop()))
+        if API_KEYS_CONFIGURED:
+            self.tasks.append(asyncio.create_task(self.upstream_loop()))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def liveness(self):
+        """Alive unless a checker task or the loop watchdog has died (their cached results would go stale)"""
+        dead = [task.get_coro().__name__ for task in self.tasks if task.done()]
+        if loop_watchdog.thread is not None and not loop_watchdog.alive():
+            dead.append("loop_watchdog")
+        return not dead, {"status": "dead" if dead else "alive", "dead_checks": dead}
+
+    def readiness(self):
+        """Reasons this node should not take new calls (empty when ready)"""
+        now = time.monotonic()
+        reasons = []
+        if startup_timings["warm_s"] is None:
+            reasons.append("warming up")
+        if DATABASE_URL:
+            checked_at = self.database["checked_at"]
+            if checked_at is None or now - checked_at > 3 * HEALTH_CHECK_INTERVAL + HEALTH_CHECK_TIMEOUT:
+                reasons.append("database check stale")
+            elif not self.database["ok"]:
+                reasons.append(f"database: {self.database['error']}")
+            elif self.database["rtt_ms"] > HEALTH_MAX_DB_RTT_MS:
+                reasons.append(f"database round-trip {self.database['rtt_ms']}ms")
+            if self.pool["saturation"] >= HEALTH_MAX_POOL_SATURATION:
+                reasons.append(f"connection pool {self.pool['in_use']}/{self.pool['size']} in use")
+        # Lag comes from the stall watchdog, so /readyz and /admin/loop-stalls see the same stalls
+        loop_lag = loop_watchdog.lag()
+        if loop_lag["max"] is not None and loop_lag["max"] > HEALTH_MAX_LOOP_LAG_MS:
+            reasons.append(f"event loop lag {loop_lag['max']}ms")
+        if API_KEYS_CONFIGURED:
+            checked_at = self.upstream["checked_at"]
+            if checked_at is None or now - checked_at > 3 * HEALTH_UPSTREAM_CHECK_INTERVAL + HEALTH_CHECK_TIMEOUT:
+                reasons.append("upstream check stale")
+            elif not self.upstream["ok"]:
+                reasons.append(f"upstream: {self.upstream['error']}")
+            elif self.upstream["connect_ms"] > HEALTH_MAX_UPSTREAM_CONNECT_MS:
+                reasons.append(f"upstream connect {self.upstream['connect_ms']}ms")
+        # Rate-limit headroom is deliberately not a reason: limits are org-wide, so every node would
+        # go unready together and callers would lose the hold/reject TwiML from admission control
+        return reasons
+
+    def snapshot(self):
+        now = time.monotonic()
+        def aged(check):
+            checked_at = check["checked_at"]
+            return {**{k: v for k, v in check.items() if k != "checked_at"},
+                    "age_s": None if checked_at is None else round(now - checked_at, 1)}
+        return {
+            "database": aged(self.database) if DATABASE_URL else "not configured",
+            "pool": self.pool if DATABASE_URL else "not configured",
+            "event_loop_lag_ms": loop_watchdog.lag(),
+            "upstream": aged(self.upstream) if API_KEYS_CONFIGURED else "not configured",
+            "rate_limit_headroom": round(rate_limit_tracker.headroom(), 3)
+        }
+
+health_monitor = HealthMonitor()
+
+# =========================================
+# EVENT LOOP WATCHDOG & PROFILING
+# =========================================
+# Both rely on sys._current_frames() (CPython) to read another thread's stack without stopping it.
+def fold_stack(frame, thread_name):
+    """Collapse a stack into flamegraph.pl's folded format: root first, frames joined by ';'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+class LoopWatchdog:
+    """
+    Detects event-loop stalls from outside the loop.
+    A task on the loop stamps a heartbeat; a daemon thread that sees the heartbeat go stale
+    for more than LOOP_STALL_THRESHOLD_MS grabs the loop thread's stack while it is still stuck.
+    """
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.stalls = deque(maxlen=LOOP_STALLS_KEPT)
+        self.stall_count = 0
+        self.longest_ms = 0.0
+        self.lag_ms = deque(maxlen=int(LOOP_LAG_WINDOW_SECONDS / LOOP_WATCHDOG_INTERVAL))  # One sample per watchdog tick
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+
+    def watch(self):
+        current = None  # Stall in progress, keyed by the heartbeat it is stuck on
+        while not self.stopping.wait(LOOP_WATCHDOG_INTERVAL):
+            heartbeat = self.heartbeat
+            stalled_ms = (time.monotonic() - heartbeat - LOOP_WATCHDOG_INTERVAL) * 1000
+            self.lag_ms.append(round(max(0.0, stalled_ms), 1))
+            if current is not None and current["heartbeat"] != heartbeat:
+                self.finish_stall(current)
+                current = None
+            if stalled_ms < LOOP_STALL_THRESHOLD_MS:
+                continue
+            if current is None:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is None:
+                    continue
+                import traceback
+                current = {
+                    "heartbeat": heartbeat,
+                    "detected_at": datetime.now().isoformat(timespec="milliseconds"),
+                    "stack": traceback.format_stack(frame),
+                    "folded": fold_stack(frame, "event-loop")
+                }
+                print(f"🐢 Event loop stalled > {LOOP_STALL_THRESHOLD_MS:.0f}ms in {current['stack'][-1].strip().splitlines()[0]}")
+            current["duration_ms"] = round(stalled_ms, 1)
+
+    def finish_stall(self, stall):
+        stall.pop("heartbeat")
+        self.stalls.append(stall)
+        self.stall_count += 1
+        self.longest_ms = max(self.longest_ms, stall["duration_ms"])
+        print(f"🐢 Event loop stall lasted ~{stall['duration_ms']:.0f}ms:\n{''.join(stall['stack'][-6:])}")
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self.beat())
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+
+    def lag(self):
+        """Latest and worst event-loop lag over LOOP_LAG_WINDOW_SECONDS, as seen by the watchdog thread"""
+        samples = list(self.lag_ms)
+        return {"last": samples[-1] if samples else None, "max": max(samples) if samples else None}
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self):
+        return {
+            "threshold_ms": LOOP_STALL_THRESHOLD_MS,
+            "stalls": self.stall_count,
+            "longest_ms": self.longest_ms,
+            "last": self.stalls[-1]["detected_at"] if self.stalls else None
+        }
+
+loop_watchdog = LoopWatchdog()
+profile_lock = asyncio.Lock()
+
+def sample_stacks(seconds, interval, loop_only):
+    """Wall-clock sampling profile of the live process (runs in a worker thread)"""
+    own_thread = threading.get_ident()
+    counts = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread or (loop_only and thread_id != loop_watchdog.loop_thread_id):
+                continue
+            name = "event-loop" if thread_id == loop_watchdog.loop_thread_id else thread_names.get(thread_id, str(thread_id))
+            counts[fold_stack(frame, name)] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+@app.get("/admin/profile")
+async def profile_process(seconds: float = 10, interval_ms: float = 5, threads: str = "loop", authenticated: bool = Depends(authenticate_admin)):
+    """
+    Sample the running process for `seconds` and return folded stacks (feed to flamegraph.pl
+    or speedscope). threads=loop samples only the event loop; threads=all samples every thread.
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if threads not in ("loop", "all"):
+        raise HTTPException(status_code=400, detail="threads must be 'loop' or 'all'")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    async with profile_lock:
+        print(f"🔬 Profiling {threads} thread(s) for {seconds}s every {interval_ms}ms")
+        counts, samples = await asyncio.to_thread(sample_stacks, seconds, max(interval_ms, 1) / 1000, threads == "loop")
+    body = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    return Response(content=body, media_type="text/plain", headers={"X-Profile-Samples": str(samples)})
+
+@app.get("/admin/loop-stalls")
+async def get_loop_stalls(authenticated: bool = Depends(authenticate_admin)):
+    """Most recent event-loop stalls, with the stack captured while the loop was stuck"""
+    return {**loop_watchdog.stats(), "recent": list(loop_watchdog.stalls)}
+
+# =========================================
+# STARTUP & WARM-UP
+# =========================================
+startup_timings = {"imported_s": None, "warm_s": None, "first_call_s": None}
+
+def warm_db_pool():
+    """Open the pool's minimum connections and make one round-trip"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    finally:
+        release_db_connection(conn)
+
+async def warm_up():
+    """Pre-build per-call payloads and open connections; /status reports healthy only after this"""
+    started = time.perf_counter()
+    twiml_templates.update(build_twiml_templates())
+    if twilio_signature_key is not None:
+        check_twilio_signature_scheme()
+    for tenant in tenants.values():
+        for max_output_tokens in (DEFAULT_MAX_OUTPUT_TOKENS, THROTTLED_MAX_OUTPUT_TOKENS):
+            tenant.session_payload(max_output_tokens)
+        tenant.dashboard_asset()
+
+    if DATABASE_URL:
+        try:
+            await asyncio.to_thread(warm_db_pool)
+        except Exception as e:
+            print(f"❌ Error warming database pool: {e}")
+    health_monitor.start()
+    loop_watchdog.start()
+    await start_background_writers()
+    await start_partition_maintenance()
+
+    # Resolve the upstream host now so the first call does not pay for DNS
+    try:
+        upstream_host, upstream_port, _ = upstream_address()
+        await asyncio.get_running_loop().getaddrinfo(upstream_host, upstream_port)
+    except Exception as e:
+        print(f"⚠️ Could not resolve upstream host during warm-up: {e}")
+
+    startup_timings["warm_s"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+    print(f"🔥 Warm and ready in {time.perf_counter() - started:.3f}s ({startup_timings['warm_s']}s after process start)")
+
+async def shut_down():
+    health_monitor.stop()
+    loop_watchdog.stop()
+    await stop_partition_maintenance()
+    await stop_background_writers()
+    if db_pool is not None:
+        db_pool.closeall()
+
+load_tenants()
+startup_timings["imported_s"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+
 # =========================================
 # MAIN
 # =========================================
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
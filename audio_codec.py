@@ -0,0 +1,295 @@
+"""
+G.711 µ-law <-> PCM16 transcoding and 8 kHz <-> 24 kHz resampling for the media stream.
+
+Twilio sends and expects 8 kHz µ-law; the realtime API gives better recognition on
+24 kHz PCM16. Everything here works on whole frames with lookup tables and NumPy
+vector ops (no per-sample Python loops), and each call keeps its own filter state so
+frames can be streamed through without clicks at frame boundaries.
+
+SilenceGate suppresses inbound line silence before it is sent upstream; it only needs
+the standard library.
+
+Run `python audio_codec.py` for a throughput benchmark in frames per core-second, or
+`python audio_codec.py --silence recording.ulaw` to measure what the gate saves on a
+recorded call (raw 8 kHz µ-law, or a PCM16 8 kHz mono .wav with numpy installed).
+"""
+import sys
+import time
+from collections import deque
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:  # Optional dependency - pcm16 audio mode needs it
+    np = None
+    NUMPY_AVAILABLE = False
+
+TWILIO_RATE = 8000
+UPSTREAM_RATE = 24000
+RATIO = UPSTREAM_RATE // TWILIO_RATE
+TWILIO_FRAME_BYTES = 160  # 20ms of 8 kHz µ-law
+
+ULAW_BIAS = 0x84
+ULAW_CLIP = 32635
+FILTER_TAPS = 48  # 16 taps per polyphase branch
+FILTER_CUTOFF = 3600 / UPSTREAM_RATE  # Telephone band edge, as a fraction of 24 kHz
+
+
+def _build_ulaw_tables():
+    """256-entry decode table and 65536-entry encode table (indexed by the PCM16 bit pattern)"""
+    codes = np.arange(256, dtype=np.int32)
+    inverted = ~codes & 0xFF
+    exponent = (inverted >> 4) & 0x07
+    mantissa = inverted & 0x0F
+    magnitude = (((mantissa << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    decode = np.where(inverted & 0x80, -magnitude, magnitude).astype(np.int16)
+
+    pcm = np.arange(-32768, 32768, dtype=np.int32)
+    sign = np.where(pcm < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(pcm), ULAW_CLIP) + ULAW_BIAS
+    exponent = np.clip(np.floor(np.log2(magnitude)).astype(np.int32) - 7, 0, 7)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    encoded = (~(sign | (exponent << 4) | mantissa)) & 0xFF
+    encode = np.empty(65536, dtype=np.uint8)
+    encode[pcm & 0xFFFF] = encoded
+    return decode, encode
+
+
+def _design_lowpass(taps, cutoff):
+    """Hamming-windowed sinc low-pass with unity DC gain"""
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+if NUMPY_AVAILABLE:
+    ULAW_DECODE, ULAW_ENCODE = _build_ulaw_tables()
+    LOWPASS = _design_lowpass(FILTER_TAPS, FILTER_CUTOFF)
+    # Polyphase branches for 3x interpolation (gain of RATIO restores the level lost to zero-stuffing)
+    UPSAMPLE_PHASES = [(LOWPASS[phase::RATIO] * RATIO).astype(np.float32) for phase in range(RATIO)]
+
+
+def ulaw_to_pcm16(data):
+    """µ-law bytes -> int16 array"""
+    return ULAW_DECODE[np.frombuffer(data, dtype=np.uint8)]
+
+
+def pcm16_to_ulaw(samples):
+    """int16 array -> µ-law bytes"""
+    return ULAW_ENCODE[samples.astype(np.int16, copy=False).view(np.uint16)].tobytes()
+
+
+def _to_int16(samples):
+    return np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+
+
+class Upsampler:
+    """Streaming 8 kHz -> 24 kHz polyphase interpolator"""
+
+    def __init__(self):
+        self.history = np.zeros(len(UPSAMPLE_PHASES[0]) - 1, dtype=np.float32)
+
+    def process(self, samples):
+        x = np.concatenate((self.history, samples.astype(np.float32)))
+        self.history = x[len(x) - len(self.history):]
+        out = np.empty(len(samples) * RATIO, dtype=np.float32)
+        for phase, branch in enumerate(UPSAMPLE_PHASES):
+            out[phase::RATIO] = np.convolve(x, branch, mode="valid")
+        return _to_int16(out)
+
+
+class Downsampler:
+    """Streaming 24 kHz -> 8 kHz decimator; tracks the output phase across odd-sized chunks"""
+
+    def __init__(self):
+        self.history = np.zeros(FILTER_TAPS - 1, dtype=np.float32)
+        self.offset = 0  # Index in the next chunk of the first sample that lands on the 8 kHz grid
+
+    def process(self, samples):
+        x = np.concatenate((self.history, samples.astype(np.float32)))
+        self.history = x[len(x) - len(self.history):]
+        filtered = np.convolve(x, LOWPASS, mode="valid")
+        out = filtered[self.offset::RATIO]
+        self.offset = (self.offset - len(samples)) % RATIO
+        return _to_int16(out)
+
+
+def _build_level_table():
+    """bytes.translate table mapping a µ-law byte to |sample| >> 7 (0..250)"""
+    table = bytearray(256)
+    for code in range(256):
+        inverted = ~code & 0xFF
+        exponent = (inverted >> 4) & 0x07
+        mantissa = inverted & 0x0F
+        table[code] = ((((mantissa << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS) >> 7
+    return bytes(table)
+
+
+ULAW_LEVEL = _build_level_table()
+
+
+def frame_level(frame):
+    """Mean absolute amplitude of a µ-law frame (C-level translate + sum, no per-sample Python)"""
+    if not frame:
+        return 0
+    return (sum(frame.translate(ULAW_LEVEL)) << 7) // len(frame)
+
+
+class SilenceGate:
+    """
+    Stateful gate deciding, per 20ms µ-law frame, what to forward upstream.
+
+    A noise floor is tracked with an exponential moving average (constant state per
+    frame). Frames are forwarded while speech is present and for hangover_ms after it,
+    so server VAD still sees the trailing silence it needs to end the turn. Suppressed
+    frames are kept in a prefix_ms ring buffer and flushed ahead of the next speech
+    onset, so VAD prefix padding never clips the start of an utterance. During long
+    silences one frame is forwarded every keepalive_ms (0 disables).
+    """
+
+    FRAME_MS = 20
+    MIN_SPEECH_LEVEL = 250  # Absolute floor so digital silence never counts as speech
+    SPEECH_RATIO = 2.5  # Speech when the level exceeds the noise floor by this factor
+    FLOOR_ALPHA = 0.05
+
+    def __init__(self, hangover_ms, prefix_ms, keepalive_ms=0):
+        self.hangover_frames = max(1, hangover_ms // self.FRAME_MS)
+        self.keepalive_frames = keepalive_ms // self.FRAME_MS
+        self.prefix = deque(maxlen=max(1, prefix_ms // self.FRAME_MS))
+        self.noise_floor = None
+        self.quiet_run = 0
+        self.suppressed_run = 0
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def process(self, frame):
+        """Return the list of frames to forward for this inbound frame (possibly empty)"""
+        level = frame_level(frame)
+        if self.noise_floor is None:
+            self.noise_floor = level
+        speech = level > max(self.MIN_SPEECH_LEVEL, self.noise_floor * self.SPEECH_RATIO)
+        if speech:
+            self.quiet_run = 0
+        else:
+            self.quiet_run += 1
+            self.noise_floor += self.FLOOR_ALPHA * (level - self.noise_floor)
+
+        if self.quiet_run <= self.hangover_frames:
+            frames = list(self.prefix)
+            frames.append(frame)
+            self.prefix.clear()
+            # Buffered prefix frames were counted as suppressed when they arrived
+            self.suppressed -= len(frames) - 1
+            self.forwarded += len(frames)
+            self.suppressed_run = 0
+            return frames
+
+        self.suppressed_run += 1
+        if self.keepalive_frames and self.suppressed_run % self.keepalive_frames == 0:
+            self.forwarded += 1
+            return [frame]
+        self.prefix.append(frame)
+        self.suppressed += 1
+        return []
+
+    def stats(self):
+        total = self.forwarded + self.suppressed
+        return {
+            "forwarded": self.forwarded,
+            "suppressed": self.suppressed,
+            "suppressed_ratio": round(self.suppressed / total, 3) if total else 0.0
+        }
+
+
+def measure_silence_savings(ulaw_bytes, hangover_ms=1000, prefix_ms=500, keepalive_ms=2000):
+    """Run a recorded call through the gate and report frames and upstream bytes saved"""
+    gate = SilenceGate(hangover_ms, prefix_ms, keepalive_ms)
+    for i in range(0, len(ulaw_bytes) - TWILIO_FRAME_BYTES + 1, TWILIO_FRAME_BYTES):
+        gate.process(ulaw_bytes[i:i + TWILIO_FRAME_BYTES])
+    stats = gate.stats()
+    # Each forwarded frame is a base64 µ-law payload in a ~50 byte input_audio_buffer.append envelope
+    frame_wire_bytes = 4 * ((TWILIO_FRAME_BYTES + 2) // 3) + 50
+    stats["upstream_bytes_saved"] = stats["suppressed"] * frame_wire_bytes
+    stats["upstream_bytes_total"] = (stats["forwarded"] + stats["suppressed"]) * frame_wire_bytes
+    return stats
+
+
+def _read_recording(path):
+    if not path.endswith(".wav"):
+        with open(path, "rb") as f:
+            return f.read()
+    import wave
+    with wave.open(path, "rb") as recording:
+        if recording.getsampwidth() != 2 or recording.getnchannels() != 1 or recording.getframerate() != TWILIO_RATE:
+            raise SystemExit("expected 8 kHz mono PCM16 .wav")
+        if not NUMPY_AVAILABLE:
+            raise SystemExit("numpy is required to read .wav recordings")
+        return pcm16_to_ulaw(np.frombuffer(recording.readframes(recording.getnframes()), dtype="<i2"))
+
+
+class CallTranscoder:
+    """
+    Per-call transcoder between Twilio (8 kHz µ-law) and the upstream (24 kHz PCM16 little-endian).
+    Output towards Twilio is only released in whole 20ms frames; the remainder is carried over.
+    """
+
+    def __init__(self):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("numpy is required for pcm16 audio mode")
+        self.upsampler = Upsampler()
+        self.downsampler = Downsampler()
+        self._pcm_carry = b""  # Odd trailing byte of a PCM16 chunk
+        self._frame_carry = b""  # Partial µ-law frame waiting for more audio
+
+    def twilio_to_upstream(self, ulaw_bytes):
+        """µ-law 8 kHz bytes -> PCM16 24 kHz bytes"""
+        return self.upsampler.process(ulaw_to_pcm16(ulaw_bytes)).astype("<i2").tobytes()
+
+    def upstream_to_twilio(self, pcm_bytes):
+        """PCM16 24 kHz bytes -> µ-law 8 kHz bytes, a whole number of Twilio frames"""
+        data = self._pcm_carry + pcm_bytes
+        usable = len(data) - (len(data) % 2)
+        self._pcm_carry = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype="<i2")
+        ulaw = self._frame_carry + pcm16_to_ulaw(self.downsampler.process(samples))
+        complete = len(ulaw) - (len(ulaw) % TWILIO_FRAME_BYTES)
+        self._frame_carry = ulaw[complete:]
+        return ulaw[:complete]
+
+    def reset_output(self):
+        """Forget buffered outbound audio (e.g. after the caller interrupts)"""
+        self.downsampler = Downsampler()
+        self._pcm_carry = b""
+        self._frame_carry = b""
+
+
+def benchmark(frames=20000):
+    """Frames per core-second for each direction, using CPU time rather than wall time"""
+    rng = np.random.default_rng(0)
+    inbound = [rng.integers(0, 256, TWILIO_FRAME_BYTES, dtype=np.uint8).tobytes() for _ in range(64)]
+    outbound = [rng.integers(-8000, 8000, TWILIO_FRAME_BYTES * RATIO, dtype=np.int16).astype("<i2").tobytes() for _ in range(64)]
+    transcoder = CallTranscoder()
+
+    results = {}
+    for name, convert, payloads in (
+        ("twilio_to_upstream", transcoder.twilio_to_upstream, inbound),
+        ("upstream_to_twilio", transcoder.upstream_to_twilio, outbound),
+    ):
+        started = time.process_time()
+        for i in range(frames):
+            convert(payloads[i % len(payloads)])
+        elapsed = time.process_time() - started
+        results[name] = frames / elapsed if elapsed else float("inf")
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--silence":
+        for path in sys.argv[2:]:
+            print(f"{path}: {measure_silence_savings(_read_recording(path))}")
+        raise SystemExit(0)
+    if not NUMPY_AVAILABLE:
+        raise SystemExit("numpy is not installed")
+    for direction, rate in benchmark().items():
+        # One call streams 50 frames per second in each direction
+        print(f"{direction}: {rate:,.0f} frames/core-second (~{rate / 50:,.0f} concurrent calls per core)")
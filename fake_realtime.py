@@ -0,0 +1,152 @@
+"""
+Fake realtime upstream for fault injection.
+
+FakeRealtimeServer speaks just enough of the realtime protocol for the app: it sends
+session.created and rate_limits.updated with a configurable share of the limit remaining,
+accepts whatever the app sends, and injects faults - it aborts each session after a
+jittered lifetime (a mid-call drop) and rejects a share of handshakes with HTTP 429 and a
+Retry-After header.
+
+Run `python fake_realtime.py serve` and set OPENAI_REALTIME_URL=ws://127.0.0.1:8765/ to
+put a whole app process (Twilio calls included) on top of it, or `python fake_realtime.py`
+to drive simulated calls through the app's UpstreamConnection in-process and report
+reconnect success rate and latency, 429 rejections and the admission decision they cause.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import time
+from http import HTTPStatus
+
+import websockets
+
+
+class FakeRealtimeServer:
+    def __init__(self, drop_after=2.0, reject_rate=0.0, retry_after=1, remaining=1.0, seed=None):
+        self.drop_after = drop_after  # Mean session lifetime in seconds before an abort (0 = never drop)
+        self.reject_rate = reject_rate  # Share of handshakes answered with 429
+        self.retry_after = retry_after
+        self.remaining = remaining  # remaining/limit reported in rate_limits.updated
+        self.random = random.Random(seed)
+        self.stats = {"handshakes": 0, "rejected": 0, "sessions": 0, "dropped": 0, "session_updates": 0, "replayed_items": 0}
+        self.server = None
+
+    def _process_request(self, connection, request):
+        self.stats["handshakes"] += 1
+        if self.random.random() < self.reject_rate:
+            self.stats["rejected"] += 1
+            response = connection.respond(HTTPStatus.TOO_MANY_REQUESTS, "Rate limit reached\n")
+            response.headers["Retry-After"] = str(self.retry_after)
+            return response
+        return None
+
+    async def _session(self, ws):
+        self.stats["sessions"] += 1
+        await ws.send(json.dumps({"type": "session.created", "session": {"id": f"sess_{self.stats['sessions']}"}}))
+        await ws.send(json.dumps({"type": "rate_limits.updated", "rate_limits": [
+            {"name": "requests", "limit": 1000, "remaining": int(1000 * self.remaining), "reset_seconds": 60},
+            {"name": "tokens", "limit": 100000, "remaining": int(100000 * self.remaining), "reset_seconds": 60}
+        ]}))
+        lifetime = self.random.uniform(0.5, 1.5) * self.drop_after if self.drop_after else None
+        try:
+            async with asyncio.timeout(lifetime):
+                async for message in ws:
+                    event_type = json.loads(message).get("type")
+                    if event_type == "session.update":
+                        self.stats["session_updates"] += 1
+                    elif event_type == "conversation.item.create":
+                        self.stats["replayed_items"] += 1
+        except TimeoutError:
+            # Abort without a close frame, like a network drop or an upstream crash
+            self.stats["dropped"] += 1
+            ws.transport.abort()
+        except websockets.ConnectionClosed:
+            pass
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await websockets.serve(self._session, host, port, process_request=self._process_request)
+        return f"ws://{host}:{self.server.sockets[0].getsockname()[1]}/v1/realtime"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def _simulated_call(app, index, seconds, outcomes):
+    """One call's upstream side, as handle_media_stream drives it: connect, consume, hang up"""
+    await asyncio.sleep(index * 0.05)  # Stagger arrivals so sessions do not all drop in lockstep
+    upstream = app.UpstreamConnection(f"fake-{index}", app.CallState(), app.tenants[app.DEFAULT_TENANT_ID])
+    try:
+        await upstream.__aenter__()
+    except Exception as e:
+        outcomes["rejected_at_connect" if app.note_upstream_connect_failure(e) else "failed_at_connect"] += 1
+        return
+    upstream.call_state.add_turn("user", f"Caller {index}: one large fajita and a Pepsi")
+
+    async def consume():
+        async for message in upstream:
+            event = json.loads(message)
+            if event.get("type") == "rate_limits.updated":
+                app.rate_limit_tracker.update(event.get("rate_limits"))
+
+    consumer = asyncio.create_task(consume())
+    await asyncio.wait({consumer}, timeout=seconds)
+    await upstream.close()
+    await consumer
+    outcomes["gave_up" if upstream.gave_up else "completed"] += 1
+
+
+async def measure(calls=20, call_seconds=6.0, drop_after=1.5, reject_rate=0.2, remaining=1.0, seed=1):
+    server = FakeRealtimeServer(drop_after, reject_rate, remaining=remaining, seed=seed)
+    url = await server.start()
+    # The app reads its settings at import time; quiet its per-event logging for the run
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        app.OPENAI_REALTIME_URL = url
+        outcomes = {"completed": 0, "gave_up": 0, "rejected_at_connect": 0, "failed_at_connect": 0}
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            _simulated_call(app, index, call_seconds, outcomes)
+            for index in range(calls)
+        ))
+        elapsed = time.perf_counter() - started
+        admission = app.rate_limit_tracker.admission_decision()
+    await server.stop()
+    reconnects = app.reconnect_stats_snapshot()
+    # Drops whose reconnect was still running when the caller hung up count as neither
+    reconnects["abandoned_at_hangup"] = reconnects["drops"] - reconnects["successes"] - reconnects["failures"]
+    return {
+        "calls": calls,
+        "elapsed_s": round(elapsed, 1),
+        "outcomes": outcomes,
+        "reconnects": reconnects,
+        "server": server.stats,
+        "headroom": round(app.rate_limit_tracker.headroom(), 3),
+        "admission_now": admission
+    }
+
+
+async def serve(port, drop_after, reject_rate, remaining):
+    server = FakeRealtimeServer(drop_after, reject_rate, remaining=remaining)
+    url = await server.start(port=port)
+    print(f"🧪 Fake realtime upstream on {url} (drop after ~{drop_after}s, {reject_rate:.0%} of handshakes get 429, {remaining:.0%} remaining)")
+    await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("mode", nargs="?", choices=("measure", "serve"), default="measure")
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--call-seconds", type=float, default=6.0)
+    parser.add_argument("--drop-after", type=float, default=1.5, help="mean session lifetime before an injected drop (0 = never)")
+    parser.add_argument("--reject-rate", type=float, default=0.2, help="share of handshakes answered with 429")
+    parser.add_argument("--remaining", type=float, default=1.0, help="remaining/limit reported in rate_limits.updated")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    if args.mode == "serve":
+        asyncio.run(serve(args.port, args.drop_after, args.reject_rate, args.remaining))
+    else:
+        print(json.dumps(asyncio.run(measure(args.calls, args.call_seconds, args.drop_after, args.reject_rate, args.remaining)), indent=2))